@@ -2,89 +2,145 @@
 
 import sys
 import os
+import json
+import multiprocessing
+import pipes
+import tempfile
+import time
 from ConfigParser import ConfigParser
 from string import Template
 
-def configureDriver(conf_dict, infile, outfile):
-        """Configures IBM Storage Scale driver from config file.
+import profiling
+
+class TemplateError(Exception):
+        pass
+
+class CompiledTemplate(object):
+        """A template read and parsed once, with the placeholders it uses.
 
         Args:
-            conf_dict (dict): Dictionary of the configuration file section
             infile (string): file path of the input template file
-            outfile (string): file path of the output configured file
 
         """
 
-        f = open(infile, "r")
-        contents = f.read()
-        f.close()
+        @profiling.timed("load")
+        def __init__(self, infile):
+                f = open(infile, "r")
+                contents = f.read()
+                f.close()
+
+                self.infile = infile
+                self.template = Template(contents)
+                self.placeholders = set()
+
+                # Other '$' sequences, like the Kubernetes '$(VAR)' args of the
+                # workloads, are not placeholders and are left as they are.
+                for match in Template.pattern.finditer(contents):
+                     name = match.group("named") or match.group("braced")
+                     if name is not None:
+                          self.placeholders.add(name)
+
+        def check(self, conf_dict):
+                """Returns the problems that would stop this template from rendering."""
+                problems = []
+                for name in sorted(self.placeholders):
+                     if conf_dict.get(name) is None:
+                          problems.append("%s: placeholder '${%s}' has no value" % (self.infile, name))
+                return problems
+
+        @profiling.timed("transform")
+        def render(self, conf_dict):
+                return self.template.safe_substitute(conf_dict)
+
+@profiling.timed("write")
+def writeIfChanged(outfile, contents):
+        """Writes the file atomically, only if its contents changed.
+
+        Returns:
+            bool: True if the file was written
 
-        s = Template(contents)
-        out = s.safe_substitute(conf_dict)
-
-        f = open(outfile,"w+")
-        f.write(out)
-        f.close()
+        """
+        try:
+             f = open(outfile, "r")
+             current = f.read()
+             f.close()
+             if current == contents:
+                  return False
+        except IOError:
+             pass
+
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(outfile)),
+                                   prefix="." + os.path.basename(outfile))
+        try:
+             f = os.fdopen(fd, "w")
+             f.write(contents)
+             f.close()
+             if os.path.exists(outfile):
+                  os.chmod(tmp, os.stat(outfile).st_mode & 0777)
+             else:
+                  umask = os.umask(0)
+                  os.umask(umask)
+                  os.chmod(tmp, 0666 & ~umask)
+             os.rename(tmp, outfile)
+        except:
+             if os.path.exists(tmp):
+                  os.remove(tmp)
+             raise
+        return True
 
 def validateCmapConfig(conf_dict):
+        errors = []
         if conf_dict.get("clusterid") == "" or conf_dict.get("clusterid") == None :
-             print "Mandatory parameter 'clusterid' in CONFIGMAP section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'clusterid' in CONFIGMAP section missing")
 
         if conf_dict.get("primaryfs") == "" or conf_dict.get("primaryfs") == None :
-             print "Mandatory parameter 'primaryfs' in CONFIGMAP section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'primaryfs' in CONFIGMAP section missing")
 
         if conf_dict.get("primaryfset") == "" or conf_dict.get("primaryfset") == None :
-             print "Mandatory parameter 'primaryfset' in CONFIGMAP section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'primaryfset' in CONFIGMAP section missing")
 
         if conf_dict.get("securesslmode") == "" or conf_dict.get("securesslmode") == None :
-             print "Mandatory parameter 'securesslmode' in CONFIGMAP section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'securesslmode' in CONFIGMAP section missing")
 
         if conf_dict.get("guihost") == "" or conf_dict.get("guihost") == None :
-             print "Mandatory parameter 'guihost' in CONFIGMAP section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'guihost' in CONFIGMAP section missing")
 
         if conf_dict.get("guiport") == "" or conf_dict.get("guiport") == None :
-             print "Mandatory parameter 'guiport' in CONFIGMAP section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'guiport' in CONFIGMAP section missing")
 
         if conf_dict.get("securesslmode") == "true" and (conf_dict.get("cacert") == "" or conf_dict.get("cacert") == None):
-             print "securesslmode is true but cacert not defined"
-	     exit(1)
+             errors.append("securesslmode is true but cacert not defined")
+        return errors
 
 def validateSecret(conf_dict):
+        errors = []
         if conf_dict.get("username") == "" or conf_dict.get("username") == None \
            or conf_dict.get("password") == "" or conf_dict.get("password") == None :
-             print "Mandatory base64 credentials in SECRET section missing"
-             exit(1)
+             errors.append("Mandatory base64 credentials in SECRET section missing")
+        return errors
 
 def validatePluginConf(conf_dict):
+        errors = []
         if conf_dict.get("scalehostpath") == "" or conf_dict.get("scalehostpath") == None:
-             print "Mandatory parameter 'scalehostpath' in PLUGIN section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'scalehostpath' in PLUGIN section missing")
+        return errors
 
 def validateImages(conf_dict):
+        errors = []
         if conf_dict.get("provisioner") == "" or conf_dict.get("provisioner") == None:
-             print "Mandatory parameter 'provisioner' in IMAGES section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'provisioner' in IMAGES section missing")
 
         if conf_dict.get("attacher") == "" or conf_dict.get("attacher") == None:
-             print "Mandatory parameter 'attacher' in IMAGES section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'attacher' in IMAGES section missing")
 
         if conf_dict.get("driverregistrar") == "" or conf_dict.get("driverregistrar") == None:
-             print "Mandatory parameter 'driverregistrar' in IMAGES section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'driverregistrar' in IMAGES section missing")
 
         if conf_dict.get("spectrumscaleplugin") == "" or conf_dict.get("spectrumscaleplugin") == None:
-             print "Mandatory parameter 'spectrumscaleplugin' in IMAGES section missing"
-             exit(1)
+             errors.append("Mandatory parameter 'spectrumscaleplugin' in IMAGES section missing")
+        return errors
 
-
-def configureCmapConfig(conf_dict, infile, outfile):
+def cmapConfig(conf_dict):
         if conf_dict.get("inodelimit") != "" and conf_dict.get("inodelimit") != None :
              inodelimitstring = '"inodeLimit":"' + conf_dict.get("inodelimit") + '",'
              conf_dict["inodelimitstr"] = inodelimitstring
@@ -96,9 +152,9 @@ def configureCmapConfig(conf_dict, infile, outfile):
         else:
              conf_dict["cacertstr"] = ""
 
-        configureDriver(conf_dict, infile, outfile)
+        return conf_dict
 
-def configurePluginConf(conf_dict, infile, outfile, usecacert):
+def pluginConf(conf_dict, usecacert):
         if usecacert:
              conf_dict["cacertline1"] = '- name: cert1'
              conf_dict["cacertline2"] = 'mountPath: /var/lib/ibm/ssl/public'
@@ -112,15 +168,14 @@ def configurePluginConf(conf_dict, infile, outfile, usecacert):
              conf_dict["volcertline2"] = ''
              conf_dict["volcertline3"] = ''
 
-        configureDriver(conf_dict, infile, outfile)
+        return conf_dict
 
-def configure(config, section, infile, outfile):
+def sectionDict(config, section):
+      """Returns the values a section's templates are rendered with."""
       conf_dict = dict(config.items(section))
 
       if section == "CONFIGMAP":
-           configureCmapConfig(conf_dict, infile, outfile)
-      elif section == "SECRET":
-           configureDriver(conf_dict, infile, outfile)
+           return cmapConfig(conf_dict)
       elif section == "PLUGIN":
            usecacert = False
            if dict(config.items("CONFIGMAP")).get("securesslmode") == "true":
@@ -129,90 +184,465 @@ def configure(config, section, infile, outfile):
            images_dict = dict(config.items("IMAGES"))
            conf_dict["driverregistrar"] = images_dict.get("driverregistrar")
            conf_dict["spectrumscaleplugin"] = images_dict.get("spectrumscaleplugin")
-           configurePluginConf(conf_dict, infile, outfile, usecacert)
-      else:
-           configureDriver(conf_dict, infile, outfile)
+           return pluginConf(conf_dict, usecacert)
+      return conf_dict
+
+def renderAll(config, outputs, templates=None):
+      """Renders all outputs in one pass.
+
+      Every template is read and compiled once and checked against its section
+      before anything is written, so a missing value fails the whole run instead
+      of leaving '${...}' behind. Outputs are only rewritten when they changed.
+
+      Args:
+          config (ConfigParser): the driver configuration
+          outputs (list): (section, infile, outfile) of each output
+          templates (dict): compiled templates by infile, shared between calls
+
+      Returns:
+          list: (outfile, written) of each output
+
+      """
+      if templates is None:
+           templates = {}
+      jobs = []
+      problems = []
+      for section, infile, outfile in outputs:
+           if infile not in templates:
+                try:
+                     templates[infile] = CompiledTemplate(infile)
+                except IOError, e:
+                     problems.append("%s: %s" % (infile, e.strerror))
+                     continue
+           conf_dict = sectionDict(config, section)
+           problems.extend(templates[infile].check(conf_dict))
+           jobs.append((templates[infile], conf_dict, outfile))
+
+      if problems:
+           raise TemplateError("\n".join(problems))
+
+      rendered = [(outfile, template.render(conf_dict)) for template, conf_dict, outfile in jobs]
+      return [(outfile, writeIfChanged(outfile, contents)) for outfile, contents in rendered]
 
 def validate(config, section):
+      """Returns every problem with the section, instead of stopping at the first."""
+      if not config.has_section(section):
+           return ["Mandatory section '%s' missing" % section]
+
       conf_dict = dict(config.items(section))
 
       if section == "CONFIGMAP":
-           validateCmapConfig(conf_dict)
+           return validateCmapConfig(conf_dict)
       elif section == "SECRET":
-           validateSecret(conf_dict)
+           return validateSecret(conf_dict)
       elif section == "PLUGIN":
-           validatePluginConf(conf_dict)
+           return validatePluginConf(conf_dict)
       else:
-           validateImages(conf_dict)
-
+           return validateImages(conf_dict)
+
+
+def deploySteps(conf_dict):
+      """Returns the (name, command, dependencies) of each deployment step."""
+      rbac = ["attacher-rbac", "nodeplugin-rbac", "provisioner-rbac"]
+      steps = []
+      steps.append(("attacher-rbac", "kubectl apply -f deploy/common/csi-attacher-rbac.yaml", []))
+      steps.append(("nodeplugin-rbac", "kubectl apply -f deploy/common/csi-nodeplugin-rbac.yaml", []))
+      steps.append(("provisioner-rbac", "kubectl apply -f deploy/common/csi-provisioner-rbac.yaml", []))
+      steps.append(("secret", "kubectl apply -f deploy/classic/spectrum-scale-secret.json", rbac))
+
+      config = ["secret", "spectrum-scale-config"]
+      if conf_dict.get("securesslmode") == "true":
+           steps.append(("cert1", "kubectl create configmap cert1 --from-file=mycertificate.pem=" + conf_dict.get("cacert"), rbac))
+           config.append("cert1")
+
+      steps.append(("spectrum-scale-config", "kubectl create configmap spectrum-scale-config --from-file=spectrum-scale-config.json=deploy/classic/spectrum-scale-config.json", rbac))
+      steps.append(("attacher", "kubectl apply -f deploy/common/csi-plugin-attacher.yaml", config))
+      steps.append(("provisioner", "kubectl apply -f deploy/common/csi-plugin-provisioner.yaml", config))
+      steps.append(("plugin", "kubectl apply -f deploy/common/csi-plugin.yaml", config))
+      return steps
+
+def deployWaves(steps):
+      """Groups the steps into waves, each step runs after the waves of its dependencies.
+
+      Returns:
+          list: the waves, each a list of (name, command) in step order
+
+      """
+      wave = {}
+      while len(wave) < len(steps):
+           progress = False
+           for name, command, dependencies in steps:
+                if name in wave or [d for d in dependencies if d not in wave]:
+                     continue
+                wave[name] = max([wave[d] + 1 for d in dependencies] + [0])
+                progress = True
+           if not progress:
+                raise ValueError("deployment steps have a dependency cycle")
+
+      waves = [[] for i in range(max(wave.values()) + 1)]
+      for name, command, dependencies in steps:
+           waves[wave[name]].append((name, command))
+      return waves
+
+# Runs each "name command" argument of a wave in the background, then prints the
+# output of each in order and fails if any of them failed.
+WAVE_FUNCTION = """wave() {
+      logs=$(mktemp -d) || exit 1
+      pids=""
+      for step in "$@"; do
+           name=${step%% *}
+           sh -c "${step#* }" > "$logs/$name" 2>&1 &
+           pids="$pids $name:$!"
+      done
+
+      failed=""
+      for entry in $pids; do
+           name=${entry%%:*}
+           wait ${entry#*:} || failed="$failed $name"
+           sed "s/^/[$name] /" "$logs/$name"
+      done
+      rm -rf "$logs"
+
+      if [ -n "$failed" ]; then
+           echo "Failed:$failed" >&2
+           return 1
+      fi
+}
+"""
+
+def generateDeployScript(config, deployscript, parallel=False):
+      """Writes the script that deploys the configured driver.
+
+      The steps run one after the other, or with parallel in dependency waves
+      (RBAC, then the secret and ConfigMaps, then the workloads) where the
+      steps of a wave run concurrently and a failed wave stops the deployment.
+
+      Returns:
+          bool: True if the script was written
+
+      """
+      waves = deployWaves(deploySteps(dict(config.items("CONFIGMAP"))))
+
+      if not parallel:
+           blocks = ["".join(command + "\n" for name, command in wave) for wave in waves]
+           return writeIfChanged(deployscript, "\n".join(blocks))
+
+      lines = ["#!/bin/sh\n", "\n", WAVE_FUNCTION]
+      for i, wave in enumerate(waves):
+           steps = " ".join(pipes.quote(name + " " + command) for name, command in wave)
+           lines.append("\necho \"Wave %d: %s\"\n" % (i + 1, ", ".join(name for name, command in wave)))
+           lines.append("wave %s || exit 1\n" % steps)
+      lines.append("\necho \"Deployment complete\"\n")
+      return writeIfChanged(deployscript, "".join(lines))
+
+
+SECTIONS = ["CONFIGMAP", "SECRET", "PLUGIN", "IMAGES"]
+
+MANIFEST = os.path.join("deploy", "classic", "spectrum-scale-driver.yaml")
+RBAC = ["csi-attacher-rbac.yaml", "csi-nodeplugin-rbac.yaml", "csi-provisioner-rbac.yaml"]
+
+def driverOutputs(templatepath, outputpath):
+      """Returns the (section, infile, outfile) of each rendered file.
+
+      Args:
+          templatepath (string): base path of the sample files (the templates)
+          outputpath (string): base path the configured files are written to
+
+      """
+      classic = os.path.join("deploy", "classic")
+      common = os.path.join("deploy", "common")
+      outputs = []
+      for section, directory, name in [
+                ("CONFIGMAP", classic, "spectrum-scale-config.json"),
+                ("SECRET", classic, "spectrum-scale-secret.json"),
+                ("PLUGIN", common, "csi-plugin.yaml"),
+                ("IMAGES", common, "csi-plugin-provisioner.yaml"),
+                ("IMAGES", common, "csi-plugin-attacher.yaml")]:
+           outputs.append((section, os.path.join(templatepath, directory, name + "_template"),
+                                    os.path.join(outputpath, directory, name)))
+      return outputs
+
+@profiling.timed("load")
+def readConfig(driverconf):
+      """Returns the parsed configuration and all of its validation errors."""
+      config = ConfigParser()
+      try:
+           if not config.read(driverconf):
+                return config, ["Unable to read '%s'" % driverconf]
+      except Exception, e:
+           return config, ["Unable to parse '%s': %s" % (driverconf, str(e).replace("\n", " "))]
+
+      errors = []
+      for section in SECTIONS:
+           errors.extend(validate(config, section))
+      return config, errors
+
+# Compiled templates of a fleet worker process, reused for every cluster it renders.
+workerTemplates = {}
+
+@profiling.timed("load")
+def readDocuments(path):
+      """Returns the documents of a YAML (or JSON) file as strings, without separators."""
+      f = open(path, "r")
+      contents = f.read()
+      f.close()
 
-def generateDeployScript(config, deployscript):
+      documents = []
+      current = []
+      for line in contents.splitlines():
+           if line.rstrip() == "---" or line.startswith("--- "):
+                documents.append("\n".join(current))
+                current = []
+                if line.startswith("--- "):
+                     current.append(line[4:])
+           else:
+                current.append(line)
+      documents.append("\n".join(current))
+      return [d for d in documents if d.strip() != ""]
+
+def configMap(name, key, contents):
+      """Returns a ConfigMap document (JSON is valid YAML) holding contents under key."""
+      return json.dumps({"apiVersion": "v1", "kind": "ConfigMap",
+                         "metadata": {"name": name},
+                         "data": {key: contents}}, indent=2, sort_keys=True)
+
+def generateManifest(config, templatepath, outputpath):
+      """Writes every object of the deployment to one ordered multi-document YAML.
+
+      This is the same order as create.sh, the RBAC, the secret, the ConfigMaps
+      (built inline instead of with 'kubectl create configmap') and then the
+      workloads, so the driver is deployed with a single 'kubectl apply -f'.
+
+      Args:
+          config (ConfigParser): the driver configuration
+          templatepath (string): base path of the sample files (the RBAC)
+          outputpath (string): base path of the rendered files
+
+      Returns:
+          bool: True if the manifest was written
+
+      """
       conf_dict = dict(config.items("CONFIGMAP"))
+      classic = os.path.join(outputpath, "deploy", "classic")
+      common = os.path.join(outputpath, "deploy", "common")
 
-      with open(deployscript, 'w+') as f:
-           f.write("kubectl apply -f deploy/common/csi-attacher-rbac.yaml\n")
-           f.write("kubectl apply -f deploy/common/csi-nodeplugin-rbac.yaml\n")
-           f.write("kubectl apply -f deploy/common/csi-provisioner-rbac.yaml\n\n")
-           f.write("kubectl apply -f deploy/classic/spectrum-scale-secret.json\n")
+      documents = []
+      for rbac in RBAC:
+           documents.extend(readDocuments(os.path.join(templatepath, "deploy", "common", rbac)))
+      documents.extend(readDocuments(os.path.join(classic, "spectrum-scale-secret.json")))
 
-           if conf_dict.get("securesslmode") == "true":
-                f.write("kubectl create configmap cert1 --from-file=mycertificate.pem=" + conf_dict.get("cacert") + "\n")
-
-           f.write("kubectl create configmap spectrum-scale-config --from-file=spectrum-scale-config.json=deploy/classic/spectrum-scale-config.json\n\n")
-           f.write("kubectl apply -f deploy/common/csi-plugin-attacher.yaml\n")
-           f.write("kubectl apply -f deploy/common/csi-plugin-provisioner.yaml\n")
-           f.write("kubectl apply -f deploy/common/csi-plugin.yaml\n")
+      if conf_dict.get("securesslmode") == "true":
+           f = open(conf_dict.get("cacert"), "r")
+           documents.append(configMap("cert1", "mycertificate.pem", f.read()))
+           f.close()
 
+      f = open(os.path.join(classic, "spectrum-scale-config.json"), "r")
+      documents.append(configMap("spectrum-scale-config", "spectrum-scale-config.json", f.read()))
       f.close()
 
-
-if len(sys.argv) != 2 or os.path.isfile(sys.argv[1]) == False :
-      print "Usage: spectrum-scale-driver.py <path_to_spectrum-scale-driver.conf>"
+      for workload in ["csi-plugin-attacher.yaml", "csi-plugin-provisioner.yaml", "csi-plugin.yaml"]:
+           documents.extend(readDocuments(os.path.join(common, workload)))
+
+      contents = "".join("---\n" + d.rstrip("\n") + "\n" for d in documents)
+      return writeIfChanged(os.path.join(outputpath, MANIFEST), contents)
+
+def copyRbac(templatepath, outputpath):
+      """Copies the RBAC files create.sh applies into the output tree.
+
+      Returns:
+          list: (outfile, written) of each RBAC file
+
+      """
+      results = []
+      for rbac in RBAC:
+           f = open(os.path.join(templatepath, "deploy", "common", rbac), "r")
+           contents = f.read()
+           f.close()
+
+           outfile = os.path.join(outputpath, "deploy", "common", rbac)
+           results.append((outfile, writeIfChanged(outfile, contents)))
+      return results
+
+def renderCluster(job):
+      """Validates and renders one fleet configuration into its own output tree.
+
+      Args:
+          job (tuple): (name, driverconf, templatepath, outputpath, manifest, parallel)
+
+      Returns:
+          dict: the report of this configuration
+
+      """
+      name, driverconf, templatepath, outputpath, manifest, parallel = job
+      report = {"name": name, "conf": driverconf, "output": outputpath,
+                "status": "ok", "written": 0, "unchanged": 0, "errors": []}
+
+      config, errors = readConfig(driverconf)
+      if errors:
+           report["status"] = "invalid"
+           report["errors"] = errors
+           return report
+
+      try:
+           for directory in ["classic", "common"]:
+                path = os.path.join(outputpath, "deploy", directory)
+                if not os.path.isdir(path):
+                     os.makedirs(path)
+
+           results = renderAll(config, driverOutputs(templatepath, outputpath), workerTemplates)
+           results.extend(copyRbac(templatepath, outputpath))
+           results.append((None, generateDeployScript(config, os.path.join(outputpath, "deploy", "classic", "create.sh"), parallel)))
+           if manifest:
+                results.append((None, generateManifest(config, templatepath, outputpath)))
+      except TemplateError, e:
+           report["status"] = "invalid"
+           report["errors"] = str(e).split("\n")
+           return report
+      except (IOError, OSError), e:
+           report["status"] = "failed"
+           report["errors"] = [str(e)]
+           return report
+
+      for outfile, written in results:
+           if written:
+                report["written"] += 1
+           else:
+                report["unchanged"] += 1
+      return report
+
+def fleet(confdir, outputdir, templatepath, jobs=None, manifest=False, parallel=False):
+      """Renders every '<name>.conf' of confdir into outputdir/<name> in a process pool.
+
+      Returns:
+          int: the exit code, 1 if any configuration failed
+
+      """
+      names = sorted(f[:-len(".conf")] for f in os.listdir(confdir) if f.endswith(".conf"))
+      if not names:
+           print "No '.conf' files found in '%s'" % confdir
+           return 1
+
+      work = [(name, os.path.join(confdir, name + ".conf"), templatepath,
+               os.path.join(outputdir, name), manifest, parallel) for name in names]
+
+      start = time.time()
+      pool = multiprocessing.Pool(jobs)
+      try:
+           chunksize = max(1, len(work) / (4 * (jobs or multiprocessing.cpu_count())))
+           with profiling.phase("pool"):
+                reports = pool.map(renderCluster, work, chunksize)
+      finally:
+           pool.close()
+           pool.join()
+      elapsed = time.time() - start
+
+      width = max(len(name) for name in names)
+      for report in reports:
+           print "%-*s  %-7s  %d written, %d unchanged" % (width, report["name"], report["status"],
+                                                        report["written"], report["unchanged"])
+           for error in report["errors"]:
+                print "%-*s    %s" % (width, "", error)
+
+      failed = len([r for r in reports if r["status"] != "ok"])
+      print "%d of %d configurations rendered in %.2fs, %d failed" % (len(reports) - failed, len(reports), elapsed, failed)
+
+      if not os.path.isdir(outputdir):
+           os.makedirs(outputdir)
+      reportfile = os.path.join(outputdir, "fleet-report.json")
+      writeIfChanged(reportfile, json.dumps(reports, indent=2, sort_keys=True) + "\n")
+      print "Report written to '%s'" % reportfile
+
+      if failed:
+           return 1
+      return 0
+
+def popOption(argv, flag):
+      """Returns the value of the flag and argv without them, None if not given."""
+      if flag not in argv or argv.index(flag) + 1 >= len(argv):
+           return None, argv
+      i = argv.index(flag)
+      return argv[i + 1], argv[:i] + argv[i + 2:]
+
+def usage():
+      print "Usage: spectrum-scale-driver.py [options] <path_to_spectrum-scale-driver.conf>"
+      print "       spectrum-scale-driver.py [options] --fleet <conf_dir> <output_dir> [jobs]"
+      print "    Options: --manifest --parallel --profile <report> --cprofile <stats>"
       print "    This command configures the IBM Storage Scale Driver. Ensure that the environment variable 'CSI_SCALE_PATH' is set to the sample files base path. Configure the CSI driver parameters in spectrum-scale-driver.conf and run 'spectrum-scale-driver.py <path_to_spectrum-scale-driver.conf'"
-      exit(1)
-
-basepath = ""
-try:
-      basepath = os.environ['CSI_SCALE_PATH']
-except:
-      print "CSI_SCALE_PATH not defined"
-      exit(1)
-
-classicbasepath = os.path.join(basepath, "deploy", "classic")
-commonbasepath = os.path.join(basepath, "deploy", "common")
-
-driverconf = sys.argv[1]
-config = ConfigParser()
-config.read(driverconf)
-
-validate(config, "CONFIGMAP")
-validate(config, "SECRET")
-validate(config, "PLUGIN")
-validate(config, "IMAGES")
-
-configure(config, "CONFIGMAP", os.path.join(classicbasepath, "spectrum-scale-config.json_template"),
-                              os.path.join(classicbasepath, "spectrum-scale-config.json"))
-print "Configured 'deploy/classic/spectrum-scale-config.json'"
-
-configure(config, "SECRET", os.path.join(classicbasepath, "spectrum-scale-secret.json_template"),
-                              os.path.join(classicbasepath, "spectrum-scale-secret.json"))
-print "Configured 'deploy/classic/spectrum-scale-secret.json'"
-
-configure(config, "PLUGIN", os.path.join(commonbasepath, "csi-plugin.yaml_template"),
-                              os.path.join(commonbasepath, "csi-plugin.yaml"))
-print "Configured 'deploy/common/csi-plugin.yaml'"
-
-configure(config, "IMAGES", os.path.join(commonbasepath, "csi-plugin-provisioner.yaml_template"),
-                              os.path.join(commonbasepath, "csi-plugin-provisioner.yaml"))
-print "Configured 'deploy/common/csi-plugin-provisioner.yaml'"
-
-configure(config, "IMAGES", os.path.join(commonbasepath, "csi-plugin-attacher.yaml_template"),
-                              os.path.join(commonbasepath, "csi-plugin-attacher.yaml"))
-print "Configured 'deploy/common/csi-plugin-attacher.yaml'"
-
-generateDeployScript(config, os.path.join(classicbasepath, "create.sh"))
-print "Generated deployment script 'deploy/classic/create.sh'"
-
-print "IBM Storage Scale CSI driver configuration is complete. Please review the configuration and run 'deploy/classic/create.sh' to deploy the driver"
-
-exit(0)
+      print "    With --fleet every <name>.conf in conf_dir is validated and rendered (with the RBAC files) into output_dir/<name>/deploy in parallel, and a summary is written to output_dir/fleet-report.json"
+      print "    With --manifest all of the objects are also written to '%s', to deploy with a single 'kubectl apply -f'" % MANIFEST
+      print "    With --parallel create.sh applies the RBAC, then the secret and ConfigMaps and then the workloads, each group in parallel"
+      print "    With --profile (or $%s) the phase timings and peak memory of the run are written to the JSON report, --cprofile (or $%s) also saves cProfile stats" % (profiling.PROFILE_ENV, profiling.CPROFILE_ENV)
+
+def main(argv):
+      manifest = "--manifest" in argv
+      parallel = "--parallel" in argv
+      argv = [arg for arg in argv if arg not in ("--manifest", "--parallel")]
+      report, argv = popOption(argv, "--profile")
+      stats, argv = popOption(argv, "--cprofile")
+      profiling.start("spectrum-scale-driver", report, stats)
+
+      fleetmode = len(argv) in (4, 5) and argv[1] == "--fleet"
+      if fleetmode:
+           if not os.path.isdir(argv[2]) or (len(argv) == 5 and not argv[4].isdigit()):
+                usage()
+                return 1
+      elif len(argv) != 2 or os.path.isfile(argv[1]) == False :
+           usage()
+           return 1
+
+      basepath = ""
+      try:
+           basepath = os.environ['CSI_SCALE_PATH']
+      except:
+           print "CSI_SCALE_PATH not defined"
+           return 1
+
+      if fleetmode:
+           jobs = None
+           if len(argv) == 5:
+                jobs = int(argv[4])
+           return fleet(argv[2], argv[3], basepath, jobs, manifest, parallel)
+
+      config, errors = readConfig(argv[1])
+      if errors:
+           for error in errors:
+                print error
+           return 1
+
+      try:
+           results = renderAll(config, driverOutputs(basepath, basepath))
+      except TemplateError, e:
+           print "Unable to render the templates, nothing was written:"
+           print e
+           return 1
+
+      for outfile, written in results:
+           relpath = os.path.relpath(outfile, basepath)
+           if written:
+                print "Configured '%s'" % relpath
+           else:
+                print "'%s' is up to date" % relpath
+
+      if generateDeployScript(config, os.path.join(basepath, "deploy", "classic", "create.sh"), parallel):
+           print "Generated deployment script 'deploy/classic/create.sh'"
+      else:
+           print "Deployment script 'deploy/classic/create.sh' is up to date"
+
+      if manifest:
+           try:
+                written = generateManifest(config, basepath, basepath)
+           except IOError, e:
+                print "Unable to generate the manifest: %s" % e
+                return 1
+
+           if written:
+                print "Generated manifest '%s', deploy it with 'kubectl apply -f %s'" % (MANIFEST, MANIFEST)
+           else:
+                print "Manifest '%s' is up to date" % MANIFEST
+           return 0
+
+      print "IBM Storage Scale CSI driver configuration is complete. Please review the configuration and run 'deploy/classic/create.sh' to deploy the driver"
+      return 0
+
+if __name__ == "__main__":
+      exit(main(sys.argv))
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+''' Run the create.sh written by spectrum-scale-driver.py against a fake kubectl and
+check the deployment order, the concurrency of each --parallel wave and that a failed
+step stops the deployment with a non-zero exit. Runs with the same python as the
+driver tool. '''
+
+from __future__ import print_function
+
+import argparse
+import imp
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+
+SCRIPT_DIR=os.path.dirname(os.path.realpath(__file__))
+DRIVER="{0}/spectrum-scale-driver.py".format(SCRIPT_DIR)
+
+DEFAULT_DELAY=0.3
+
+# The step the failure run breaks, its wave still finishes but no later wave starts.
+FAILING_STEP="secret"
+
+# Records the start and end of every call in $FAKE_KUBECTL_LOG, a call whose
+# arguments contain $FAKE_KUBECTL_FAIL fails instead.
+FAKE_KUBECTL='''#!{python}
+import json, os, sys, time
+
+args = " ".join(sys.argv[1:])
+def record(event):
+  with open(os.environ["FAKE_KUBECTL_LOG"], "a") as log:
+    log.write(json.dumps([event, time.time(), args]) + "\\n")
+
+record("start")
+time.sleep(float(os.environ.get("FAKE_KUBECTL_DELAY", "0")))
+fail = os.environ.get("FAKE_KUBECTL_FAIL")
+if fail and fail in args:
+  record("fail")
+  sys.stderr.write("error: fake failure of {{0}}\\n".format(args))
+  sys.exit(1)
+record("end")
+print("applied {{0}}".format(args))
+'''
+
+
+def load_driver():
+  ''' Import spectrum-scale-driver.py for its deployment steps and script writer. '''
+  return imp.load_source("spectrum_scale_driver", DRIVER)
+
+
+def fake_kubectl(workdir):
+  ''' Write the fake kubectl, returns the directory to put first on the PATH. '''
+  bindir = "{0}/bin".format(workdir)
+  os.makedirs(bindir)
+  kubectl = "{0}/kubectl".format(bindir)
+  with open(kubectl, "w") as stream:
+    stream.write(FAKE_KUBECTL.format(python=sys.executable))
+  os.chmod(kubectl, os.stat(kubectl).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+  return bindir
+
+
+def run_script(driver, workdir, bindir, parallel, delay, fail=None):
+  ''' Write create.sh and run it, returns the exit status, its stderr and the
+  start, end and failure time of each step by name. '''
+  config = driver.ConfigParser()
+  config.add_section("CONFIGMAP")
+  config.set("CONFIGMAP", "securesslmode", "true")
+  config.set("CONFIGMAP", "cacert", "{0}/ca.pem".format(workdir))
+
+  steps = driver.deploySteps(dict(config.items("CONFIGMAP")))
+  names = dict((command.split(" ", 1)[1], name) for name, command, deps in steps)
+
+  script = "{0}/create.sh".format(workdir)
+  if os.path.exists(script):
+    os.remove(script)
+  driver.generateDeployScript(config, script, parallel)
+
+  log = "{0}/kubectl.log".format(workdir)
+  if os.path.exists(log):
+    os.remove(log)
+
+  env = dict(os.environ, PATH="{0}{1}{2}".format(bindir, os.pathsep, os.environ.get("PATH", "")),
+             FAKE_KUBECTL_LOG=log, FAKE_KUBECTL_DELAY=str(delay), FAKE_KUBECTL_FAIL=fail or "")
+  p = subprocess.Popen(["sh", script], cwd=workdir, env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+  out, err = p.communicate()
+
+  events = {}
+  if os.path.exists(log):
+    with open(log, "r") as stream:
+      for line in stream:
+        event, when, args = json.loads(line)
+        events.setdefault(names[args], {})[event] = when
+
+  return steps, p.returncode, err, events
+
+
+def check_order(steps, events):
+  ''' Every step starts after all of its dependencies ended. '''
+  problems = []
+  for name, command, deps in steps:
+    if name not in events:
+      problems.append("{0} did not run".format(name))
+      continue
+    for dep in deps:
+      if dep in events and events[name]["start"] < events[dep].get("end", 0):
+        problems.append("{0} started before {1} ended".format(name, dep))
+  return problems
+
+
+def check_overlap(waves, events):
+  ''' The steps of each wave ran at the same time. '''
+  problems = []
+  for i, wave in enumerate(waves):
+    names = [ name for name, command in wave ]
+    if len(names) < 2 or [ n for n in names if "end" not in events.get(n, {}) ]:
+      continue
+    if max(events[n]["start"] for n in names) >= min(events[n]["end"] for n in names):
+      problems.append("wave {0} ({1}) did not run concurrently".format(i + 1, ", ".join(names)))
+  return problems
+
+
+def check_serial(steps, events):
+  ''' Without --parallel every step runs after the previous one ended. '''
+  problems = []
+  for (previous, c, d), (name, command, deps) in zip(steps, steps[1:]):
+    if events[name]["start"] < events[previous]["end"]:
+      problems.append("{0} overlapped {1}".format(name, previous))
+  return problems
+
+
+def check_failure(steps, waves, rc, err, events):
+  ''' A failed step fails the script, finishes its own wave and stops the later ones. '''
+  problems = []
+  if rc == 0:
+    problems.append("create.sh exited with 0 after {0} failed".format(FAILING_STEP))
+  if "Failed: {0}".format(FAILING_STEP) not in err:
+    problems.append("the failure of {0} was not reported: {1}".format(FAILING_STEP, err.strip()))
+
+  failed = [ i for i, wave in enumerate(waves) if FAILING_STEP in [ n for n, c in wave ] ][0]
+  for i, wave in enumerate(waves):
+    for name, command in wave:
+      if i <= failed and name not in events:
+        problems.append("{0} did not run".format(name))
+      if i > failed and name in events:
+        problems.append("{0} ran after wave {1} failed".format(name, failed + 1))
+  return problems
+
+
+def main(args):
+  parser = argparse.ArgumentParser(
+      description='''Run the create.sh written by spectrum-scale-driver.py against a fake kubectl
+and check the step order, the concurrency of the --parallel waves and the failure handling.''')
+
+  parser.add_argument( '--delay', metavar='seconds', dest='delay', type=float,
+      default=DEFAULT_DELAY,
+      help='''How long each fake kubectl call takes, long enough for the waves to overlap.''')
+  parser.add_argument( '--keep', dest='keep', action='store_true',
+      help='''Keep the work directory (the scripts and the kubectl log).''')
+
+  args = parser.parse_args()
+
+  driver  = load_driver()
+  workdir = tempfile.mkdtemp(prefix="deploy-waves-")
+  found   = []
+  try:
+    bindir = fake_kubectl(workdir)
+
+    steps, rc, err, events = run_script(driver, workdir, bindir, False, args.delay)
+    problems = check_order(steps, events) + check_serial(steps, events)
+    if rc != 0:
+      problems.append("create.sh exited with {0}: {1}".format(rc, err.strip()))
+    found.append(("sequential", problems))
+
+    steps, rc, err, events = run_script(driver, workdir, bindir, True, args.delay)
+    waves = driver.deployWaves(steps)
+    problems = check_order(steps, events) + check_overlap(waves, events)
+    if rc != 0:
+      problems.append("create.sh exited with {0}: {1}".format(rc, err.strip()))
+    found.append(("parallel", problems))
+
+    steps, rc, err, events = run_script(driver, workdir, bindir, True, args.delay,
+      dict((name, command) for name, command, deps in steps)[FAILING_STEP].split(" ", 1)[1])
+    found.append(("parallel failure", check_failure(steps, waves, rc, err, events)))
+  finally:
+    if args.keep:
+      print("Work directory kept in {0}".format(workdir))
+    else:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  failed = 0
+  for check, problems in found:
+    print("{0:<18} {1}".format(check, "FAIL" if problems else "ok"))
+    for problem in problems:
+      print("  {0}".format(problem))
+    failed += len(problems)
+
+  return 1 if failed else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -0,0 +1,405 @@
+''' Packaging engine for the operator bundle.
+
+The bundle entries (the package manifest and the files of the CSV directory)
+are compressed in parallel, zlib releases the GIL, and then written to the zip
+in a stable order with normalized timestamps and permissions, so the same
+inputs always give the same archive bytes.
+'''
+
+import errno
+import fcntl
+import gzip
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import tarfile
+import time
+import zipfile
+import zlib
+import profiling
+from concurrent.futures import ThreadPoolExecutor
+
+ZIP_STORED   = 0
+ZIP_DEFLATED = 8
+
+# Every entry gets the same timestamp and a 0644 regular file mode.
+DEFAULT_EPOCH = 315532800 # 1980-01-01, the earliest zip timestamp.
+FILE_MODE     = 0o100644
+
+# The content manifest written beside a bundle.
+MANIFEST_POSTFIX = ".manifest.json"
+CHUNK            = 1 << 20
+
+# ioctl(dest, FICLONE, src) shares the extents of src with dest (btrfs, xfs).
+FICLONE = 0x40049409
+
+LOCAL_HEADER   = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_OF_CENTRAL = struct.Struct("<IHHHHIIH")
+
+class Entry(object):
+  ''' A compressed bundle entry, ready to be written to the archive. '''
+  __slots__ = ("name", "crc", "size", "method", "data", "reused")
+
+  def __init__(self, name, crc, size, method, data, reused=False):
+    self.name   = name
+    self.crc    = crc
+    self.size   = size
+    self.method = method
+    self.data   = data
+    self.reused = reused
+
+class Previous(object):
+  ''' The members of a previously built archive, their compressed bytes can be
+  copied into a new archive without compressing them again. '''
+
+  def __init__(self, zipname):
+    self.zipname = zipname
+    self.members = {}
+
+    with zipfile.ZipFile(zipname, 'r') as archive, open(zipname, 'rb') as stream:
+      for info in archive.infolist():
+        if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED) or info.flag_bits & 0x1:
+          continue
+
+        # The data follows the local header, whose extra field may differ from
+        # the one in the central directory.
+        stream.seek(info.header_offset)
+        header = LOCAL_HEADER.unpack(stream.read(LOCAL_HEADER.size))
+        offset = info.header_offset + LOCAL_HEADER.size + header[9] + header[10]
+        self.members[info.filename] = (info.CRC, info.file_size, info.compress_type,
+          offset, info.compress_size)
+
+  def reuse(self, name, crc, size):
+    ''' The (method, compressed bytes) of the member if it has the same content,
+    None otherwise. '''
+    member = self.members.get(name)
+    if member is None or member[0] != crc or member[1] != size:
+      return None
+
+    with open(self.zipname, 'rb') as stream:
+      stream.seek(member[3])
+      return member[2], stream.read(member[4])
+
+def collect(packagefile, csvdir):
+  ''' The (archive name, path) of the bundle files, the package manifest first
+  and then the CSV directory in name order. '''
+  entries = [ (os.path.basename(packagefile), packagefile) ]
+  for config in sorted(os.listdir(csvdir)):
+    path = "{0}/{1}".format(csvdir, config)
+    if os.path.isfile(path):
+      entries.append((config, path))
+  return entries
+
+def dosTime(epoch=None):
+  ''' The DOS date and time of the archive timestamp (SOURCE_DATE_EPOCH if set). '''
+  if epoch is None:
+    epoch = int(os.environ.get("SOURCE_DATE_EPOCH", DEFAULT_EPOCH))
+  t = time.gmtime(max(epoch, DEFAULT_EPOCH))
+  return ((t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday,
+          t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2)
+
+@profiling.timed("compress")
+def compress(name, path, level, previous=None):
+  ''' Read and deflate a file, it is stored if deflating does not shrink it. An
+  unchanged (CRC and size) member of the previous archive is reused as is. '''
+  with open(path, 'rb') as stream:
+    content = stream.read()
+
+  crc = zlib.crc32(content) & 0xffffffff
+  if previous is not None:
+    reused = previous.reuse(name, crc, len(content))
+    if reused is not None:
+      return Entry(name, crc, len(content), reused[0], reused[1], reused=True)
+
+  compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  data = compressor.compress(content) + compressor.flush()
+
+  if len(data) >= len(content):
+    return Entry(name, crc, len(content), ZIP_STORED, content)
+  return Entry(name, crc, len(content), ZIP_DEFLATED, data)
+
+def compressAll(entries, level=6, workers=None, previous=None, stats=None):
+  ''' Compress the (name, path) entries in parallel, yields the compressed entries
+  in the order given as each becomes ready. The reused and rebuilt entries are
+  counted in stats if supplied. '''
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = [ pool.submit(compress, name, path, level, previous) for name, path in entries ]
+    for future in futures:
+      entry = future.result()
+      if stats is not None:
+        stats["reused" if entry.reused else "rebuilt"] += 1
+      yield entry
+
+def writeZip(entries, zipname, epoch=None):
+  ''' Write the compressed entries as a zip archive, returns the number written.
+  The archive is written next to the target and renamed into place. '''
+  date, clock = dosTime(epoch)
+
+  tmp = "{0}.{1}.tmp".format(zipname, os.getpid())
+  try:
+    with open(tmp, 'wb') as out:
+      written = writeEntries(out, entries, date, clock)
+  except BaseException:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+    raise
+
+  os.replace(tmp, zipname)
+  return written
+
+@profiling.timed("write")
+def writeEntries(out, entries, date, clock):
+  ''' Write the local headers and data of the entries, then the central directory. '''
+  central = []
+  offset  = 0
+  for entry in entries:
+    name  = entry.name.encode("utf-8")
+    flags = 0x800 if len(name) != len(entry.name) else 0
+    if max(offset, entry.size, len(entry.data)) >= 0xffffffff:
+      raise ValueError("{0} is too large for a zip without zip64".format(entry.name))
+
+    out.write(LOCAL_HEADER.pack(0x04034b50, 20, flags, entry.method, clock, date,
+      entry.crc, len(entry.data), entry.size, len(name), 0))
+    out.write(name)
+    out.write(entry.data)
+
+    central.append(CENTRAL_HEADER.pack(0x02014b50, 3 << 8 | 20, 20, flags,
+      entry.method, clock, date, entry.crc, len(entry.data), entry.size,
+      len(name), 0, 0, 0, 0, FILE_MODE << 16, offset) + name)
+    offset += LOCAL_HEADER.size + len(name) + len(entry.data)
+
+  size = sum(len(header) for header in central)
+  for header in central:
+    out.write(header)
+  out.write(END_OF_CENTRAL.pack(0x06054b50, 0, 0, len(central), len(central),
+    size, offset, 0))
+
+  return len(central)
+
+@profiling.timed("write")
+def writeTar(entries, out, compress=False, epoch=None):
+  ''' Stream the (name, path) entries to the binary file object as a tar (gzip
+  compressed if asked), returns the number written. The stream is built one
+  block at a time so memory stays bounded, and the headers are normalized like
+  the zip ones so the bytes are reproducible. '''
+  if epoch is None:
+    epoch = int(os.environ.get("SOURCE_DATE_EPOCH", DEFAULT_EPOCH))
+
+  zipped = gzip.GzipFile(filename="", mode='wb', fileobj=out, mtime=epoch) if compress else None
+  written = 0
+  with tarfile.open(fileobj=zipped or out, mode='w|', format=tarfile.PAX_FORMAT) as archive:
+    for name, path in entries:
+      info = tarfile.TarInfo(name)
+      info.size  = os.path.getsize(path)
+      info.mtime = epoch
+      info.mode  = FILE_MODE & 0o777
+      info.uid   = info.gid = 0
+      info.uname = info.gname = "root"
+      with open(path, 'rb') as stream:
+        archive.addfile(info, stream)
+      written += 1
+
+  if zipped is not None:
+    zipped.close()
+  out.flush()
+  return written
+
+def cloneFile(src, dst):
+  ''' Reflink src to dst, raises OSError if the filesystem cannot. '''
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+def copyRange(src, dst):
+  ''' Copy src to dst in the kernel with copy_file_range, raises OSError if it is
+  not supported for these files. '''
+  if not hasattr(os, "copy_file_range"):
+    raise OSError(errno.ENOSYS, "copy_file_range is not available")
+
+  with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+    remaining = os.fstat(fsrc.fileno()).st_size
+    while remaining > 0:
+      copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+      if copied == 0:
+        break
+      remaining -= copied
+
+# The ways to stage a file, in the order auto tries them. A hardlink shares the
+# file with the source so it is only used when asked for.
+STAGERS = [
+  ("reflink", cloneFile),
+  ("copy_file_range", copyRange),
+  ("copy", shutil.copyfile) ]
+
+def stageFile(src, dst, mode="auto"):
+  ''' Stage src at dst (replacing it atomically), returns how it was staged. '''
+  tmp = "{0}.{1}.tmp".format(dst, os.getpid())
+  try:
+    if mode == "hardlink":
+      os.link(src, tmp)
+      os.replace(tmp, dst)
+      return "hardlink"
+
+    for name, stager in STAGERS:
+      if mode not in ("auto", name):
+        continue
+      try:
+        stager(src, tmp)
+      except OSError:
+        if mode != "auto" or name == "copy":
+          raise
+        continue
+
+      shutil.copymode(src, tmp)
+      st = os.stat(src)
+      os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+      os.replace(tmp, dst)
+      return name
+  finally:
+    if os.path.exists(tmp):
+      os.remove(tmp)
+
+  raise ValueError("unknown staging mode '{0}'".format(mode))
+
+def unchanged(src, dst):
+  ''' True if dst is src (a hardlink) or was staged from it and not changed since. '''
+  try:
+    ssrc = os.stat(src)
+    sdst = os.stat(dst)
+  except OSError:
+    return False
+
+  if (ssrc.st_dev, ssrc.st_ino) == (sdst.st_dev, sdst.st_ino):
+    return True
+  return (ssrc.st_size, ssrc.st_mtime_ns) == (sdst.st_size, sdst.st_mtime_ns)
+
+@profiling.timed("write")
+def stage(entries, dirname, mode="auto"):
+  ''' Stage the (name, path) entries into the directory, creating it if needed.
+  Files that are already staged are left alone and files this tool staged
+  before (in the manifest beside the directory) that are no longer part of the
+  bundle are removed. Other files are never touched, so a non-empty directory
+  without a manifest is refused. Returns a count for each way of staging. '''
+  staged = set()
+  previous = manifestName(dirname)
+  if os.path.isfile(previous):
+    staged = set(readManifest(previous))
+  elif os.path.isdir(dirname) and os.listdir(dirname):
+    raise OSError(errno.ENOTEMPTY, "not empty and not a previous staging directory "
+      "(no {0})".format(os.path.basename(previous)), dirname)
+
+  os.makedirs(dirname, exist_ok=True)
+  stats = {}
+
+  names = set()
+  for name, path in entries:
+    names.add(name)
+    target = "{0}/{1}".format(dirname, name)
+    how = "unchanged" if unchanged(path, target) else stageFile(path, target, mode)
+    stats[how] = stats.get(how, 0) + 1
+
+  for name in sorted(staged - names):
+    target = "{0}/{1}".format(dirname, name)
+    if os.path.isfile(target):
+      os.remove(target)
+      stats["removed"] = stats.get("removed", 0) + 1
+
+  return stats
+
+def hashFile(path):
+  ''' The (size, sha256) of a file, read through mmap so large files are hashed
+  without copying them into memory. '''
+  sha = hashlib.sha256()
+  with open(path, 'rb') as stream:
+    size = os.fstat(stream.fileno()).st_size
+    if size > 0:
+      with mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as view:
+        sha.update(view)
+  return size, sha.hexdigest()
+
+def hashStream(stream):
+  ''' The (size, sha256) of a file object, read in chunks. '''
+  sha  = hashlib.sha256()
+  size = 0
+  for chunk in iter(lambda: stream.read(CHUNK), b''):
+    sha.update(chunk)
+    size += len(chunk)
+  return size, sha.hexdigest()
+
+@profiling.timed("hash")
+def manifest(entries, workers=None):
+  ''' The content manifest of the (name, path) entries, hashed in parallel
+  (hashlib releases the GIL). '''
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    hashes = list(pool.map(hashFile, [ path for name, path in entries ]))
+  return [ { "path": name, "size": size, "sha256": sha }
+           for (name, path), (size, sha) in zip(entries, hashes) ]
+
+def manifestName(target):
+  ''' The manifest beside a zip or staging directory. '''
+  return "{0}{1}".format(target.rstrip("/"), MANIFEST_POSTFIX)
+
+def writeManifest(files, filename):
+  ''' Write the manifest atomically. '''
+  tmp = "{0}.{1}.tmp".format(filename, os.getpid())
+  with open(tmp, 'w') as stream:
+    json.dump({ "files": files }, stream, indent=2, sort_keys=True)
+    stream.write("\n")
+  os.replace(tmp, filename)
+
+def readManifest(filename):
+  ''' The files of a manifest, keyed by path. '''
+  with open(filename, 'r') as stream:
+    return dict((f["path"], f) for f in json.load(stream)["files"])
+
+@profiling.timed("hash")
+def verify(target, filename=None, workers=None):
+  ''' Check a zip or staging directory against its manifest without extracting
+  anything to disk, returns a list of problems (empty if it matches). '''
+  expected = readManifest(filename or manifestName(target))
+  problems = []
+
+  if os.path.isdir(target):
+    names = sorted(name for name in os.listdir(target)
+      if os.path.isfile("{0}/{1}".format(target, name)))
+    check = lambda name: hashFile("{0}/{1}".format(target, name))
+    sizes = dict((name, os.path.getsize("{0}/{1}".format(target, name))) for name in names)
+  else:
+    with zipfile.ZipFile(target, 'r') as archive:
+      infos = archive.infolist()
+    names = [ info.filename for info in infos ]
+    sizes = dict((info.filename, info.file_size) for info in infos)
+    def check(name):
+      # Each worker reads through its own handle, members are inflated in memory.
+      try:
+        with zipfile.ZipFile(target, 'r') as own, own.open(name) as stream:
+          return hashStream(stream)
+      except (zipfile.BadZipFile, zlib.error) as e:
+        return None, "unreadable ({0})".format(e)
+
+  for name in names:
+    if name not in expected:
+      problems.append("{0}: not in the manifest".format(name))
+  for name in sorted(expected):
+    if name not in sizes:
+      problems.append("{0}: missing".format(name))
+
+  # Sizes are compared first so only plausible files are hashed.
+  candidates = []
+  for name in names:
+    if name not in expected:
+      continue
+    if sizes[name] != expected[name]["size"]:
+      problems.append("{0}: size {1} != {2}".format(name, sizes[name], expected[name]["size"]))
+    else:
+      candidates.append(name)
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for name, (size, sha) in zip(candidates, pool.map(check, candidates)):
+      if sha != expected[name]["sha256"]:
+        problems.append("{0}: sha256 {1} != {2}".format(name, sha, expected[name]["sha256"]))
+
+  return problems
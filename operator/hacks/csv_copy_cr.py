@@ -4,6 +4,9 @@ import argparse
 import sys
 import os
 import yaml
+import yaml_io
+import profiling
+from stage_manifest import Stage
 import json
 
 BASE_DIR="{0}/../".format(os.path.dirname(os.path.realpath(__file__)))
@@ -11,41 +14,57 @@ DEFAULT_VERSION="2.6.0"
 CSV_PATH="{0}deploy/olm-catalog/ibm-spectrum-scale-csi-operator/{1}/ibm-spectrum-scale-csi-operator.v{1}.clusterserviceversion.yaml"
 CR="{0}/deploy/crds/{1}"
 
+@profiling.timed("transform")
+def copyCR(csv, cr):
+  ''' Set the CR, or a list of CRs, (without namespaces) as the alm-examples of the CSV. '''
+  annotations = csv.get("metadata",{}).get("annotations",{})
+  for example in (cr if isinstance(cr, list) else [cr]):
+    example.get("metadata",{}).pop("namespace", None)
+  annotations["alm-examples"] = json.dumps(cr)
+
 def main(args):
   parser = argparse.ArgumentParser(
     description='''A hack to copy commented CRS into the CSV.''')
   
-  parser.add_argument( '--cr', metavar='cr', dest='cr', default=None,
-      help='''The Custom Resource File.''')
+  parser.add_argument( '--cr', metavar='cr', dest='cr', nargs='+', default=None,
+      help='''The Custom Resource Files, globs or directories (relative to deploy/crds). Several
+CRs are parsed in parallel and set as a list in the alm-examples.''')
 
   parser.add_argument( '--version', metavar='CSV Version', dest='version', default=DEFAULT_VERSION,
     help='''The version of the CSV to update''')
 
+  parser.add_argument( '--force', dest='force', action='store_true',
+    help='''Run even if the inputs did not change since the last run.''')
 
+  profiling.addArguments(parser)
   args = parser.parse_args()
+  profiling.start("csv_copy_cr", args.profile, args.cprofile)
+
+  crfs = yaml_io.expandPaths(args.cr or [], CR.format(BASE_DIR, ""))
+  if not crfs:
+    parser.error("no Custom Resource files found")
 
-  crf=CR.format(BASE_DIR,args.cr)
   csvf = CSV_PATH.format(BASE_DIR, args.version)
+  fingerprint = Stage("csv_copy_cr", [csvf] + crfs, [csvf])
+  if not args.force and fingerprint.upToDate():
+    print("{0} is up to date".format(csvf))
+    return 0
 
   csv = None
-  cr = None
+  crs = []
   try:
-    with open(crf, 'r') as stream:
-      cr = yaml.safe_load(stream)
-    with open(csvf, 'r') as stream:
-      csv = yaml.safe_load(stream)
+    crs = [ cr for cr in yaml_io.loadAll(crfs) if cr is not None ]
+    csv = yaml_io.load(csvf)
   except yaml.YAMLError as e:
     print(e)
     return 1
 
   # Remove namespace from the CR and update CSV
-  if cr is not None and csv is not None:
-    annotations = csv.get("metadata",{}).get("annotations",{})
-    cr.get("metadata",{}).pop("namespace", None)
-    annotations["alm-examples"] = json.dumps(cr)
+  if crs and csv is not None:
+    copyCR(csv, crs[0] if len(crs) == 1 else crs)
 
-    with open(csvf, 'w') as outfile:
-      yaml.dump(csv, outfile, default_flow_style=False)
+    yaml_io.dump(csv, csvf)
+    fingerprint.record()
       
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
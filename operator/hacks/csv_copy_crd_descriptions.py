@@ -4,6 +4,10 @@ import argparse
 import sys
 import os
 import yaml
+import yaml_io
+import profiling
+from stage_manifest import Stage
+from collections import deque
 
 BASE_DIR="{0}/../".format(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_VERSION="2.6.0"
@@ -11,44 +15,80 @@ CSV_PATH="{0}deploy/olm-catalog/ibm-spectrum-scale-csi-operator/{1}/ibm-spectrum
 CRD_SOURCE_PATH="{0}deploy/crds/{1}"
 CRD_TARGET_PATH="{0}deploy/olm-catalog/ibm-spectrum-scale-csi-operator/{1}/{2}"
 
-def loadDescriptors(descType, crd, csv, descriptorMap={}):
-    props = crd.get("spec", {})    \
-        .get("validation",{})      \
-        .get("openAPIV3Schema", {})\
-        .get("properties", {})     \
-    
+def crdSchema(crd):
+    ''' Get the openAPIV3Schema of the CRD, from the legacy spec.validation or from
+    spec.versions (the storage version, else the first with a schema). '''
+    spec   = crd.get("spec", {})
+    schema = spec.get("validation", {}).get("openAPIV3Schema")
+    if schema is not None:
+        return schema
+
+    versions = sorted(spec.get("versions", []), key=lambda v: not v.get("storage", False))
+    for version in versions:
+        schema = version.get("schema", {}).get("openAPIV3Schema")
+        if schema is not None:
+            return schema
+
+    return {}
+
+def crdVersion(crd):
+    ''' Get the version of the CRD, the storage version for multi-version CRDs. '''
+    spec = crd.get("spec", {})
+    if "version" in spec:
+        return spec["version"]
+
+    versions = spec.get("versions", [])
+    for version in versions:
+        if version.get("storage", False):
+            return version.get("name", "v1")
+
+    return versions[0].get("name", "v1") if versions else "v1"
+
+def subProperties(prop, allProperties=False):
+    ''' Get the properties nested in a schema node. Arrays of objects are always
+    descended into, nested objects and additionalProperties maps only with
+    allProperties. '''
+    while isinstance(prop, dict):
+        items = prop.get("items")
+        if isinstance(items, dict):
+            if "properties" in items:
+                return items["properties"]
+            prop = items
+        elif not allProperties:
+            break
+        elif "properties" in prop:
+            return prop["properties"]
+        elif isinstance(prop.get("additionalProperties"), dict):
+            prop = prop["additionalProperties"]
+        else:
+            break
+
+    return {}
+
+def loadDescriptors(descType, crd, csv, descriptorMap={}, allProperties=False):
+    ''' Build the descriptors breadth first, each queued path carries its schema
+    node so the schema is walked once. '''
+    props = crdSchema(crd).get("properties", {})
+
     spec            = props.get(descType, {})
-    specprops       = spec.get("properties", {})
     specdescriptors = []
-    specpaths       = specprops.keys()
-    
+    specpaths       = deque(spec.get("properties", {}).items())
+
     while len(specpaths) > 0:
-        # Load the path and then iterate to get the property.
-        path    = specpaths.pop(0)
-        keys    = path.split(".")
-        name    = keys[-1]
-        prop    = spec
-        subprops = specprops
-        displayName = name
-  
-        for key in keys:
-            prop     = subprops.get(key, {})
-            subprops = prop.get("items",{}).get("properties", {})
+        path, prop = specpaths.popleft()
 
-        
         # Enqueue the sub properties (if present)
-        for subprop in subprops.keys():
-            specpaths.append("{0}.{1}".format(path,subprop))
-        
-        
+        for subprop, subschema in subProperties(prop, allProperties).items():
+            specpaths.append(("{0}.{1}".format(path, subprop), subschema))
+
         desc = descriptorMap.get(path,{})
         # Construct description
-        specdescriptors.append({ 
-          "displayName" : desc.get("displayName", displayName),
+        specdescriptors.append({
+          "displayName" : desc.get("displayName", path.rsplit(".", 1)[-1]),
           "x-descriptors": desc.get("x-descriptors", []),
           "path" : path,
           "description" : prop.get("description", "") })
-        
+
     return specdescriptors
 
 def mapDescriptors(metaname, spec):
@@ -64,69 +104,107 @@ def mapDescriptors(metaname, spec):
 
   return (specMap, statusMap)
 
+def ownedIndex(csv):
+    ''' Index the owned CRDs of the CSV by name, a name maps to all of its entries. '''
+    index = {}
+    owned = csv.get("spec",{}).get("customresourcedefinitions",{}).get("owned",{})
+    for resource in owned:
+        index.setdefault(resource.get("name",""), []).append(resource)
+    return index
+
+@profiling.timed("transform")
+def copyDescriptors(csv, crd, allProperties=False, index=None):
+    ''' Copy the CRD descriptions into the owned CRD descriptors of the CSV. Pass
+    the ownedIndex of the CSV when copying several CRDs into it. '''
+    metaname= crd.get("metadata",{}).get("name", "")
+    if index is None:
+        index = ownedIndex(csv)
+
+    owned = csv.get("spec",{}).get("customresourcedefinitions",{}).get("owned",{})
+    resources = index.get(metaname, [])
+    specmap, statusmap =  mapDescriptors(metaname, resources)
+
+    specdescriptors = loadDescriptors("spec", crd, csv, specmap, allProperties)
+    statusdescriptors = loadDescriptors("status", crd, csv, statusmap, allProperties)
+
+    for resource in resources:
+        resource["specDescriptors"] = specdescriptors
+        resource["statusDescriptors"] = statusdescriptors
+        resource["version"] = crdVersion(crd)
+
+    # If the resource wasn't present in the customresourcedefinitions add it. 
+    if not resources:
+        resource = {
+            "name"            : metaname,
+            "kind"            : crd.get("kind","CustomResourceDefinition"),
+            "version"         : crdVersion(crd),
+            "displayName"     : metaname,
+            "specDescriptors" : specdescriptors,
+            "description"     : "TODO: Fill this in"}
+        owned.append(resource)
+        index[metaname] = [resource]
+
+def copyAllDescriptors(csv, crds, allProperties=False):
+    ''' Copy the descriptions of every CRD into the CSV, indexing it once. '''
+    index = ownedIndex(csv)
+    for crd in crds:
+        copyDescriptors(csv, crd, allProperties, index)
+
 def main(args):
     parser = argparse.ArgumentParser(
         description='''A hack to clone descriptions from the CRD.''')
     
-    parser.add_argument( '--crd', metavar='crd', dest='crd', default=None,
-        help='''The Custom Resource Definition File.''')
+    parser.add_argument( '--crd', metavar='crd', dest='crd', nargs='+', default=None,
+        help='''The Custom Resource Definition Files, globs or directories (relative to
+deploy/crds). Several CRDs are parsed in parallel and copied in one pass.''')
 
     parser.add_argument( '--version', metavar='CSV Version', dest='version', default=DEFAULT_VERSION,
       help='''The version of the CSV to update''')
 
+    parser.add_argument( '--all-properties', dest='allproperties', action='store_true',
+      help='''Also generate descriptors for the fields of nested objects and maps, by
+default only arrays of objects are descended into.''')
+
+    parser.add_argument( '--force', dest='force', action='store_true',
+      help='''Run even if the inputs did not change since the last run.''')
+
+    profiling.addArguments(parser)
     args = parser.parse_args()
+    profiling.start("csv_copy_crd_descriptions", args.profile, args.cprofile)
 
     
-    crdf = CRD_SOURCE_PATH.format(BASE_DIR, args.crd)
-    csvf = CSV_PATH.format(BASE_DIR, args.version)
+    crdfs = yaml_io.expandPaths(args.crd or [], CRD_SOURCE_PATH.format(BASE_DIR, ""))
+    if not crdfs:
+        parser.error("no Custom Resource Definition files found")
 
-    crd = None
+    csvf = CSV_PATH.format(BASE_DIR, args.version)
+    crdtargets = [ CRD_TARGET_PATH.format(BASE_DIR, args.version, os.path.basename(crdf))
+                   for crdf in crdfs ]
+    fingerprint = Stage("csv_copy_crd_descriptions", [csvf] + crdfs, [csvf] + crdtargets,
+      [args.allproperties])
+    if not args.force and fingerprint.upToDate():
+        print("{0} is up to date".format(csvf))
+        return 0
+
+    crds = []
     csv = None
     try:
-        with open(crdf, 'r') as stream:
-            crd = yaml.safe_load(stream)
-        with open(csvf, 'r') as stream:
-            csv = yaml.safe_load(stream)
+        crds = yaml_io.loadAll(crdfs)
+        csv = yaml_io.load(csvf)
     except yaml.YAMLError as e:
         print(e)
         return 1
 
-    if crd is not None and csv is not None:
-        metaname= crd.get("metadata",{}).get("name", "")
-
-        # TODO need to replace with something 
-        resourcefound=False
-        owned = csv.get("spec",{}).get("customresourcedefinitions",{}).get("owned",{})
-        specmap, statusmap =  mapDescriptors(metaname, owned)
-
-        specdescriptors = loadDescriptors("spec", crd, csv, specmap)
-        statusdescriptors = loadDescriptors("status", crd, csv, statusmap)
-
-        for resource in owned:
-            if resource.get("name","") == metaname:
-                resourcefound = True
-                resource["specDescriptors"] = specdescriptors
-                resource["statusDescriptors"] = statusdescriptors
-                resource["version"] = crd.get("spec",{}).get("version","v1")
-
-        # If the resource wasn't present in the customresourcedefinitions add it. 
-        if not resourcefound:
-            owned.append({
-                "name"            : metaname,
-                "kind"            : crd.get("kind","CustomResourceDefinition"),
-                "version"         : crd.get("spec",{}).get("version","v1"),
-                "displayName"     : metaname,
-                "specDescriptors" : specdescriptors,
-                "description"     : "TODO: Fill this in"})
+    if None not in crds and csv is not None:
+        copyAllDescriptors(csv, crds, args.allproperties)
 
         # Copy the updated CSV
-        with open(csvf, 'w') as outfile:
-            yaml.dump(csv, outfile, default_flow_style=False)
+        yaml_io.dump(csv, csvf)
 
-        # Copy the CRD
-        crdtarget=CRD_TARGET_PATH.format(BASE_DIR, args.version, os.path.basename(crdf))
-        with open(crdtarget, 'w') as outfile:
-          yaml.dump(crd, outfile, default_flow_style=False)
+        # Copy the CRDs
+        for crd, crdtarget in zip(crds, crdtargets):
+            yaml_io.dump(crd, crdtarget)
+        fingerprint.record()
         
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
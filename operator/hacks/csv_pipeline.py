@@ -0,0 +1,253 @@
+#!/bin/python
+
+import argparse
+import sys
+import os
+import yaml
+import time
+import yaml_io
+import profiling
+import bundle
+from stage_manifest import Stage
+
+from csv_prep import prepCSV, BASE_DIR, DEFAULT_VERSION, CSV_PATH
+from csv_copy_cr import copyCR, CR
+from csv_copy_docs import copyDocs, QUICKSTART
+from csv_copy_crd_descriptions import copyAllDescriptors, CRD_SOURCE_PATH, CRD_TARGET_PATH
+
+# The stages in the order they are applied to the CSV.
+STAGES=["prep", "cr", "docs", "crd"]
+
+PACKAGE_POSTFIX="package.yaml"
+
+def applyStages(csv, stages, crs=(), crds=(), docs=None, allProperties=False):
+  ''' Apply the stages to the loaded CSV, always in the STAGES order. A single CR
+  is the alm-examples object, several are a list. '''
+  for stage in STAGES:
+    if stage not in stages:
+      continue
+
+    if stage == "prep":
+      prepCSV(csv)
+    elif stage == "cr" and crs:
+      copyCR(csv, crs[0] if len(crs) == 1 else list(crs))
+    elif stage == "docs" and docs is not None:
+      copyDocs(csv, docs)
+    elif stage == "crd" and crds:
+      copyAllDescriptors(csv, crds, allProperties)
+
+def readDocs(path):
+  with open(path, 'r') as stream:
+    return stream.read()
+
+def snapshot(path):
+  ''' The (mtime, size) of the file, None if it does not exist. '''
+  try:
+    st = os.stat(path)
+  except OSError:
+    return None
+  return (st.st_mtime_ns, st.st_size)
+
+def findPackage(csvdir):
+  ''' The package manifest next to the version directory of the CSV, None if missing. '''
+  packagedir = os.path.dirname(os.path.realpath(csvdir))
+  for name in sorted(os.listdir(packagedir)):
+    if name.endswith(PACKAGE_POSTFIX):
+      return "{0}/{1}".format(packagedir, name)
+  return None
+
+def rebuildBundle(packagefile, csvdir, zipname):
+  ''' Rebuild the bundle zip, reusing the compressed entries that did not change. '''
+  entries  = bundle.collect(packagefile, csvdir)
+  previous = bundle.Previous(zipname) if os.path.isfile(zipname) else None
+  stats    = { "reused": 0, "rebuilt": 0 }
+  bundle.writeZip(bundle.compressAll(entries, previous=previous, stats=stats), zipname)
+  bundle.writeManifest(bundle.manifest(entries), bundle.manifestName(zipname))
+  return stats
+
+def watch(args, stages, csvf, crfs, crdfs, crdtargets, docs):
+  ''' Keep the CSV, CR, CRD and docs loaded and poll them for changes. Only the
+  stages of a changed input are applied again (all of them if the CSV itself was
+  changed by someone else), then the CSV and the bundle are rewritten. '''
+  inputs = { csvf: stages }
+  loaders = { csvf: yaml_io.load }
+  watched = [ (crf, "cr", yaml_io.load) for crf in crfs ]
+  watched += [ (crdf, "crd", yaml_io.load) for crdf in crdfs ]
+  watched += [ (docs, "docs", readDocs) ]
+  for path, stage, loader in watched:
+    if path is not None:
+      inputs[path]  = [stage]
+      loaders[path] = loader
+
+  packagefile = None
+  if args.bundle is not None:
+    packagefile = findPackage(os.path.dirname(csvf))
+    if packagefile is None:
+      print("Unable to find the package manifest for {0}".format(csvf))
+      return 1
+
+  objects = {}
+  seen    = dict((path, None) for path in inputs)
+  print("Watching {0} (Ctrl-C to stop)".format(", ".join(sorted(os.path.normpath(p) for p in inputs))))
+  try:
+    while True:
+      changed = [ path for path in inputs if snapshot(path) != seen[path] ]
+      if not changed:
+        time.sleep(args.interval)
+        continue
+
+      start  = time.time()
+      loaded = {}
+      try:
+        for path in changed:
+          loaded[path] = (snapshot(path), loaders[path](path))
+      except (yaml.YAMLError, IOError, OSError) as e:
+        # Likely saved half way, it is loaded again on its next save. The other
+        # changed inputs are still unseen, so they are applied on the next poll.
+        print("Unable to load {0}: {1}".format(os.path.normpath(path), e))
+        seen[path] = snapshot(path)
+        continue
+
+      for path, (snap, obj) in loaded.items():
+        seen[path]    = snap
+        objects[path] = obj
+
+      rerun = set()
+      for path in changed:
+        rerun.update(inputs[path])
+
+      csv = objects.get(csvf)
+      if csv is None:
+        continue
+      crs  = [ objects[p] for p in crfs if objects.get(p) is not None ]
+      crds = [ objects[p] for p in crdfs if objects.get(p) is not None ]
+      applyStages(csv, rerun, crs, crds, objects.get(docs), args.allproperties)
+
+      # The CSV written here is not a change to react to.
+      written = yaml_io.dump(csv, csvf)
+      seen[csvf] = snapshot(csvf)
+      # The CRD copies live beside the CSV, so they are bundle members too.
+      members = written
+      for crdf, crdtarget in zip(crdfs, crdtargets):
+        if crdf in changed and objects.get(crdf) is not None:
+          members = yaml_io.dump(objects[crdf], crdtarget) or members
+      Stage("csv_pipeline", [csvf, docs] + crfs + crdfs, [csvf] + crdtargets,
+        [stages, args.allproperties]).record()
+
+      message = "{0}: applied {1}".format(", ".join(os.path.basename(p) for p in changed),
+        ",".join(s for s in STAGES if s in rerun))
+      if args.bundle is not None and (members or not os.path.isfile(args.bundle)):
+        stats = rebuildBundle(packagefile, os.path.dirname(csvf), args.bundle)
+        message += ", rebuilt {0} ({reused} reused, {rebuilt} rebuilt)".format(args.bundle, **stats)
+      elif not written:
+        message += ", CSV unchanged"
+      print("[{0}] {1} in {2:.0f}ms".format(time.strftime("%H:%M:%S"), message,
+        (time.time() - start) * 1000))
+      sys.stdout.flush()
+  except KeyboardInterrupt:
+    return 0
+
+def main(args):
+  parser = argparse.ArgumentParser(
+    description='''Regenerate the CSV in a single pass: load it once, apply the prep, CR,
+docs and CRD descriptor hacks in order and write it once.''')
+
+  parser.add_argument( '--version', metavar='CSV Version', dest='version', default=DEFAULT_VERSION,
+    help='''The version of the CSV to update''')
+
+  parser.add_argument( '--cr', metavar='cr', dest='cr', nargs='+', default=None,
+    help='''The Custom Resource Files, globs or directories relative to deploy/crds (the cr
+stage is skipped if not supplied).''')
+
+  parser.add_argument( '--crd', metavar='crd', dest='crd', nargs='+', default=None,
+    help='''The Custom Resource Definition Files, globs or directories relative to
+deploy/crds (the crd stage is skipped if not supplied).''')
+
+  parser.add_argument( '--docs', metavar='docs', dest='docs', default=QUICKSTART,
+    help='''The markdown to use as the CSV description.''')
+
+  parser.add_argument( '--stages', metavar='stages', dest='stages', default=",".join(STAGES),
+    help='''Comma separated stages to run, always applied in the order {0}.'''.format(",".join(STAGES)))
+
+  parser.add_argument( '--all-properties', dest='allproperties', action='store_true',
+    help='''Also generate descriptors for the fields of nested objects and maps.''')
+
+  parser.add_argument( '--force', dest='force', action='store_true',
+    help='''Run even if the inputs did not change since the last run.''')
+
+  parser.add_argument( '--watch', dest='watch', action='store_true',
+    help='''Keep running, and apply the stages of an input again whenever it changes.''')
+
+  parser.add_argument( '--interval', metavar='seconds', dest='interval', type=float, default=0.2,
+    help='''How often --watch polls the inputs for changes.''')
+
+  parser.add_argument( '--bundle', metavar='ZIP Archive', dest='bundle', default=None,
+    help='''With --watch, also rebuild this bundle zip whenever the CSV or a CRD copy changes
+(and when it does not exist yet).''')
+
+  profiling.addArguments(parser)
+  args = parser.parse_args()
+  profiling.start("csv_pipeline", args.profile, args.cprofile)
+
+  stages = args.stages.split(",")
+  for stage in stages:
+    if stage not in STAGES:
+      parser.error("unknown stage '{0}'".format(stage))
+
+  if args.cr is None and "cr" in stages:
+    stages.remove("cr")
+  if args.crd is None and "crd" in stages:
+    stages.remove("crd")
+
+  csvf       = CSV_PATH.format(BASE_DIR, args.version)
+  crfs       = []
+  crdfs      = []
+  if "cr" in stages:
+    crfs = yaml_io.expandPaths(args.cr, CR.format(BASE_DIR, ""))
+  if "crd" in stages:
+    crdfs = yaml_io.expandPaths(args.crd, CRD_SOURCE_PATH.format(BASE_DIR, ""))
+  crdtargets = [ CRD_TARGET_PATH.format(BASE_DIR, args.version, os.path.basename(crdf))
+                 for crdf in crdfs ]
+  docs       = args.docs if "docs" in stages else None
+
+  if args.watch:
+    return watch(args, stages, csvf, crfs, crdfs, crdtargets, docs)
+
+  fingerprint = Stage("csv_pipeline", [csvf, docs] + crfs + crdfs, [csvf] + crdtargets,
+    [stages, args.allproperties])
+  if not args.force and fingerprint.upToDate():
+    print("{0} is up to date".format(csvf))
+    return 0
+
+  csv  = None
+  crs  = []
+  crds = []
+  try:
+    # The CRs and CRDs are parsed together, in parallel.
+    loaded = yaml_io.loadAll([ csvf ] + crfs + crdfs)
+    csv    = loaded[0]
+    crs    = loaded[1:1 + len(crfs)]
+    crds   = loaded[1 + len(crfs):]
+  except yaml.YAMLError as e:
+    print(e)
+    return 1
+
+  if csv is None:
+    return 0
+
+  applyStages(csv, stages, [ cr for cr in crs if cr is not None ],
+    [ crd for crd in crds if crd is not None ],
+    readDocs(docs) if docs is not None else None, args.allproperties)
+
+  yaml_io.dump(csv, csvf)
+
+  # Copy the CRDs
+  for crd, crdtarget in zip(crds, crdtargets):
+    if crd is not None:
+      yaml_io.dump(crd, crdtarget)
+  fingerprint.record()
+
+  print("Applied {0} to {1}".format(",".join(s for s in STAGES if s in stages), csvf))
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -4,11 +4,19 @@ import argparse
 import sys
 import os
 import yaml
+import yaml_io
+import profiling
+from stage_manifest import Stage
 
 BASE_DIR="{0}/../".format(os.path.dirname(os.path.realpath(__file__)))
 DEFAULT_VERSION="2.6.0"
 CSV_PATH="{0}deploy/olm-catalog/ibm-spectrum-scale-csi-operator/{1}/ibm-spectrum-scale-csi-operator.v{1}.clusterserviceversion.yaml"
 
+@profiling.timed("transform")
+def prepCSV(csv):
+  ''' Strip the install strategy so the CSV can be regenerated. '''
+  csv.get("spec",{}).pop("install", None)
+
 def main(args):
   parser = argparse.ArgumentParser(
     description='''A hack to prep the CSV for regeneration.''')
@@ -16,24 +24,33 @@ def main(args):
   parser.add_argument( '--version', metavar='CSV Version', dest='version', default=DEFAULT_VERSION,
     help='''The version of the CSV to update''')
 
+  parser.add_argument( '--force', dest='force', action='store_true',
+    help='''Run even if the inputs did not change since the last run.''')
+
+  profiling.addArguments(parser)
   args = parser.parse_args()
+  profiling.start("csv_prep", args.profile, args.cprofile)
   
   csvf = CSV_PATH.format(BASE_DIR, args.version)
+  fingerprint = Stage("csv_prep", [csvf], [csvf])
+  if not args.force and fingerprint.upToDate():
+    print("{0} is up to date".format(csvf))
+    return 0
+
   csv = None
   try:
-    with open(csvf, 'r') as stream:
-      csv = yaml.safe_load(stream)
+    csv = yaml_io.load(csvf)
   except yaml.YAMLError as e:
     print(e)
     return 1
 
   # Edit the contents of the CSV 
   if csv is not None:
-    csv.get("spec",{}).pop("install", None)
+    prepCSV(csv)
 
 
-  with open(csvf, 'w') as outfile:
-    yaml.dump(csv, outfile, default_flow_style=False)
+  yaml_io.dump(csv, csvf)
+  fingerprint.record()
       
 if __name__ == "__main__":
     sys.exit(main(sys.argv))
@@ -3,8 +3,11 @@ import argparse
 import sys
 import os
 import yaml
-import zipfile
-from shutil import copyfile
+import time
+import yaml_io
+import profiling
+import bundle
+from concurrent.futures import ThreadPoolExecutor
 
 
 BASE_DIR="{0}/..".format(os.path.dirname(os.path.realpath(__file__)))
@@ -14,6 +17,88 @@ OPERATOR="{0}/ibm-spectrum-scale-csi-operator".format(OLM_CATALOG)
 
 PACKAGE_POSTFIX="package.yaml"
 
+def findCSVDir(packagedir, packages, currentcsv):
+  ''' The version directory holding the currentCSV (a name ending in the version). '''
+  csvdir = None
+  if currentcsv:
+    for package in packages:
+      if currentcsv.endswith( package ):
+        csvdir = "{0}/{1}".format(packagedir, package)
+  return csvdir
+
+def build(args, packagefile, packagename, csvdir, output):
+  ''' Zip (or stage) a single bundle, returns the target and a list of messages. '''
+  messages = []
+  entries  = bundle.collect(packagefile, csvdir)
+
+  # zip the used files, the archive is byte for byte reproducible.
+  if not args.nozip:
+    previous = None
+    stats    = { "reused": 0, "rebuilt": 0 }
+    if args.incremental:
+      previousname = args.previous or output
+      if os.path.isfile(previousname):
+        previous = bundle.Previous(previousname)
+
+    bundle.writeZip(bundle.compressAll(entries, args.level, args.jobs, previous, stats), output)
+    if args.incremental:
+      messages.append("Reused {reused} entries, rebuilt {rebuilt}".format(**stats))
+  else:
+    # Stage into the directory, an existing staging directory is updated in place.
+    stats = bundle.stage(entries, output, args.stagemode)
+    messages.append("Staged {0}".format(", ".join("{0} {1}".format(count, how)
+      for how, count in sorted(stats.items()))))
+
+  # The manifest of the bundle content, for --verify.
+  manifest = bundle.manifestName(output)
+  bundle.writeManifest(bundle.manifest(entries, args.jobs), manifest)
+  messages.append("Wrote the content manifest {0}".format(manifest))
+
+  return output, messages
+
+def bundleSize(target):
+  ''' The size of a zip, or the total size of a staged directory. '''
+  if os.path.isdir(target):
+    return sum(os.path.getsize("{0}/{1}".format(target, name)) for name in os.listdir(target))
+  return os.path.getsize(target)
+
+def buildAll(args, packagefile, packagename, bundles):
+  ''' Build the (version, csvdir) bundles concurrently into the output directory,
+  then print a summary table. Returns the number of failed bundles. '''
+  outdir = args.output or os.getcwd()
+  os.makedirs(outdir, exist_ok=True)
+
+  def timed(version, csvdir):
+    output = "{0}/{1}-{2}".format(outdir, packagename, version)
+    if not args.nozip:
+      output = "{0}.zip".format(output)
+    start = time.time()
+    target, messages = build(args, packagefile, packagename, csvdir, output)
+    return target, messages, time.time() - start
+
+  failed = 0
+  rows   = []
+  with ThreadPoolExecutor(max_workers=min(len(bundles), os.cpu_count() or 1)) as pool:
+    futures = [ (version, pool.submit(timed, version, csvdir)) for version, csvdir in bundles ]
+    for version, future in futures:
+      try:
+        target, messages, elapsed = future.result()
+      except (IOError, OSError, ValueError) as e:
+        failed += 1
+        rows.append((version, "FAILED: {0}".format(e), "-", "-"))
+        continue
+      for message in messages:
+        print("{0}: {1}".format(version, message))
+      rows.append((version, target, "{0}".format(bundleSize(target)), "{0:.3f}".format(elapsed)))
+
+  widths = [ max(len(row[i]) for row in rows + [("version", "bundle", "bytes", "seconds")])
+             for i in range(4) ]
+  for row in [("version", "bundle", "bytes", "seconds")] + rows:
+    print("  ".join(cell.ljust(width) if i < 2 else cell.rjust(width)
+      for i, (cell, width) in enumerate(zip(row, widths))))
+
+  return failed
+
 def main( args ):
   parser = argparse.ArgumentParser(
       description='''
@@ -36,12 +121,70 @@ it will be placed in that location.''')
   parser.add_argument( '--nozip',  dest='nozip', 
       action='store_true',
       help='''A flag to not zip the operator (useful for courier scans).''')
+
+  parser.add_argument( '--tar', dest='tar', choices=["tar", "tgz"], default=None,
+      help='''Stream the bundle as a tar (or gzip compressed tar) to the output, stdout if
+the output is not supplied or is -, instead of writing a zip. Nothing else is written.''')
+
+  parser.add_argument( '--stage-mode', dest='stagemode',
+      choices=["auto", "hardlink", "reflink", "copy_file_range", "copy"], default="auto",
+      help='''How --nozip stages the files. auto tries a reflink, then an in-kernel
+copy_file_range and then a plain copy. hardlink shares the files with the source.''')
+
+  parser.add_argument( '-j', '--jobs', metavar='jobs', dest='jobs', type=int,
+      default=None,
+      help='''The number of files to compress in parallel (defaults to the CPU count).''')
+
+  parser.add_argument( '--level', metavar='level', dest='level', type=int,
+      default=6,
+      help='''The deflate compression level (0-9).''')
+
+  parser.add_argument( '-i', '--incremental', dest='incremental', action='store_true',
+      help='''Copy the compressed data of files that did not change from the existing
+archive (or --previous) instead of compressing them again.''')
+
+  parser.add_argument( '--previous', metavar='ZIP Archive', dest='previous', default=None,
+      help='''The archive to reuse unchanged entries from with --incremental, defaults
+to the output archive.''')
+
+  parser.add_argument( '--all-channels', dest='allchannels', action='store_true',
+      help='''Build a bundle for the currentCSV of every channel (instead of the default
+channel), concurrently. Bundles are named <package-name>-<version> in the output directory.''')
+
+  parser.add_argument( '--versions', metavar='versions', dest='versions', default=None,
+      help='''Comma separated version directories to build bundles for, like --all-channels.''')
+
+  parser.add_argument( '--verify', metavar='bundle', dest='verify', default=None,
+      help='''Check an existing zip or staging directory against its content manifest
+(path, size and sha256) without extracting it, instead of building.''')
+
+  parser.add_argument( '--manifest', metavar='manifest', dest='manifest', default=None,
+      help='''The manifest to --verify against, defaults to <bundle>.manifest.json.''')
   
+  profiling.addArguments(parser)
   args = parser.parse_args()
+  profiling.start("package_operator", args.profile, args.cprofile)
+
+  if args.tar and (args.nozip or args.allchannels or args.versions):
+    parser.error("--tar streams a single bundle, it cannot be used with --nozip, --all-channels or --versions")
+
+  if args.verify is not None:
+    try:
+      problems = bundle.verify(args.verify, args.manifest, args.jobs)
+    except (IOError, OSError, ValueError, KeyError) as e:
+      print("Unable to verify {0}: {1}".format(args.verify, e))
+      return 1
+
+    for problem in problems:
+      print(problem)
+    if problems:
+      return 1
+    print("{0} matches its manifest".format(args.verify))
+    return 0
 
   # Find the packages
   packagedir = args.packagedir  
-  if packagedir[0] is not '/':
+  if packagedir[0] != '/':
     packagedir = "{0}/{1}".format( os.getcwd(), packagedir )
 
   
@@ -62,18 +205,37 @@ it will be placed in that location.''')
     return 1
   
   pkgobj={}
-  with open(packagefile, 'r') as stream:
-    try:
-      pkgobj = yaml.safe_load(stream)
-    except yaml.YAMLError as e:
-      print(e)
-      return 1
+  try:
+    pkgobj = yaml_io.load(packagefile)
+  except yaml.YAMLError as e:
+    print(e)
+    return 1
 
   # cache details. 
   packagename     = pkgobj.get("packageName"   , "package")
   defaultchannel  = pkgobj.get("defaultChannel", None) 
   selectedchannel = None
 
+  # Build every channel (or the requested versions) from the one manifest.
+  if args.allchannels or args.versions:
+    bundles = []
+    if args.versions:
+      for version in args.versions.split(","):
+        if not os.path.isdir("{0}/{1}".format(packagedir, version)):
+          print("Unable to find version directory '{0}'.".format(version))
+          return 1
+        bundles.append((version, "{0}/{1}".format(packagedir, version)))
+    else:
+      for channel in pkgobj.get("channels", []):
+        csvdir = findCSVDir(packagedir, packages, channel.get("currentCSV", None))
+        if csvdir is None:
+          print("Unable to find the CSV of channel '{0}'.".format(channel.get("name", "")))
+          return 1
+        if csvdir not in [ b[1] for b in bundles ]:
+          bundles.append((os.path.basename(csvdir), csvdir))
+
+    return 1 if buildAll(args, packagefile, packagename, bundles) else 0
+
   # Get selected channels.
   for channel in pkgobj.get("channels", []):
     if channel.get("name", "") == defaultchannel:
@@ -81,38 +243,48 @@ it will be placed in that location.''')
       break
 
   # Determine the correct directory. 
-  currentcsv = selectedchannel.get("currentCSV", None)
-  csvdir     = None
-  if currentcsv:
-    for package in packages:
-      if currentcsv.endswith( package ):
-        csvdir = "{0}/{1}".format(packagedir, package)
+  csvdir = findCSVDir(packagedir, packages, selectedchannel.get("currentCSV", None))
+
+  # Stream the bundle, the status goes to stderr so stdout only has the archive.
+  if args.tar:
+    entries = bundle.collect(packagefile, csvdir)
+    try:
+      if args.output is None or args.output == "-":
+        bundle.writeTar(entries, sys.stdout.buffer, args.tar == "tgz")
+      else:
+        with open(args.output, 'wb') as out:
+          bundle.writeTar(entries, out, args.tar == "tgz")
+    except (IOError, OSError) as e:
+      sys.stderr.write("Unable to stream the package: {0}\n".format(e))
+      return 1
+
+    sys.stderr.write("Package {0} was streamed as {1}\n".format(packagename, args.tar))
+    return 0
 
   # Determine the zip file.
   zipname = "{0}.zip".format(packagename)
   if args.output is not None:
     if os.path.isdir(args.output):
-      zipname = "{0}/{1}".format(zipname, args.output)
+      zipname = "{0}/{1}".format(args.output, zipname)
     else:
       zipname = args.output
 
-  # zip the used files.
-  if not args.nozip:
-    with  zipfile.ZipFile(zipname, 'w') as packagezip:
-      packagezip.write(packagefile, packagefilename)
+  if args.nozip:
+    zipname = args.output or packagename
 
-      for config in os.listdir(csvdir):
-        packagezip.write("{0}/{1}".format( csvdir, config), config)
-  else:
-    dirname= "{0}".format( args.output )
-    os.mkdir(dirname)
-    copyfile(packagefile, "{0}/{1}".format(dirname, packagefilename))
+  try:
+    zipname, messages = build(args, packagefile, packagename, csvdir, zipname)
+  except OSError as e:
+    if args.nozip:
+      print("Unable to stage the package with '{0}': {1}".format(args.stagemode, e))
+    else:
+      print("Unable to bundle the package: {0}".format(e))
+    return 1
 
-    for config in os.listdir(csvdir):
-      copyfile("{0}/{1}".format( csvdir, config), "{0}/{1}".format(dirname, config))
+  for message in messages:
+    print(message)
 
   print("Package {0} was bundled to {1}".format(packagename, zipname))
 
 if __name__ == "__main__":
   sys.exit(main(sys.argv))
-
@@ -0,0 +1,169 @@
+''' Phase timing and profiling for the Python tooling.
+
+A run is profiled with --profile <report> (or HACKS_PROFILE set to a report
+path or directory). The time spent in each phase (load, transform, dump, write,
+subprocess, ...), the CPU time and the peak memory of the run are then written
+to the report as JSON when the process exits. Phases timed in several threads
+add up, so they can exceed the wall time. --cprofile <stats> (or
+HACKS_CPROFILE) also runs cProfile, saves its stats and adds the hottest
+functions to the report. When profiling is off a phase costs a function call.
+
+This module is shared with the Python 2 driver tools, so it stays compatible
+with both. The tools are copied out of the source tree on their own, so a copy
+ships next to each of them (tools/ansible/deploy/hacks and
+driver/csiplugin/tools), keep the copies identical to this one.
+'''
+
+import atexit
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_ENV="HACKS_PROFILE"
+CPROFILE_ENV="HACKS_CPROFILE"
+
+# The number of functions reported from the cProfile stats.
+HOTSPOTS=20
+
+_profile = None
+
+class Profile(object):
+  ''' The phase timings of one run of a tool. '''
+
+  def __init__(self, tool, report, cprofile=None):
+    self.tool     = tool
+    self.report   = report
+    self.cprofile = cprofile
+    self.phases   = {}
+    self.lock     = threading.Lock()
+    self.start    = time.time()
+    self.times    = os.times()
+    self.profiler = None
+    self.done     = False
+
+    if cprofile:
+      import cProfile
+      self.profiler = cProfile.Profile()
+      self.profiler.enable()
+
+  def add(self, name, seconds):
+    with self.lock:
+      phase = self.phases.setdefault(name, { "seconds": 0.0, "count": 0 })
+      phase["seconds"] += seconds
+      phase["count"]   += 1
+
+  def hotspots(self):
+    ''' The functions with the most cumulative time in the cProfile stats. '''
+    import pstats
+    stats = pstats.Stats(self.profiler)
+    rows  = []
+    own   = os.path.splitext(os.path.realpath(__file__))[0]
+    for (filename, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+      if os.path.splitext(os.path.realpath(filename))[0] == own:
+        continue
+      rows.append({ "function": "{0}:{1}({2})".format(filename, line, function),
+                    "calls": nc, "tottime": tt, "cumtime": ct })
+    rows.sort(key=lambda row: row["cumtime"], reverse=True)
+    return rows[:HOTSPOTS]
+
+  def stop(self):
+    ''' Stop profiling and write the report, only the first call does anything. '''
+    if self.done:
+      return
+    self.done = True
+
+    times = os.times()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    result = {
+      "tool"      : self.tool,
+      "argv"      : sys.argv,
+      "pid"       : os.getpid(),
+      "start"     : self.start,
+      "wall"      : time.time() - self.start,
+      "user"      : times[0] - self.times[0],
+      "system"    : times[1] - self.times[1],
+      "peak_rss"  : usage.ru_maxrss * scale,
+      "children_peak_rss" : children.ru_maxrss * scale,
+      "phases"    : self.phases }
+
+    if self.profiler is not None:
+      self.profiler.disable()
+      self.profiler.dump_stats(self.cprofile)
+      result["cprofile"] = self.cprofile
+      result["hotspots"] = self.hotspots()
+
+    report = self.report
+    if os.path.isdir(report):
+      report = os.path.join(report, "{0}-{1}-{2}.json".format(self.tool,
+        time.strftime("%Y%m%dT%H%M%S", time.gmtime(self.start)), os.getpid()))
+
+    try:
+      tmp = "{0}.{1}.tmp".format(report, os.getpid())
+      with open(tmp, 'w') as stream:
+        json.dump(result, stream, indent=2, sort_keys=True)
+        stream.write("\n")
+      os.rename(tmp, report)
+      sys.stderr.write("Profile written to {0}\n".format(report))
+    except (IOError, OSError) as e:
+      sys.stderr.write("Unable to write the profile {0}: {1}\n".format(report, e))
+
+def addArguments(parser):
+  ''' Add --profile and --cprofile to an argparse parser. '''
+  parser.add_argument( '--profile', metavar='report', dest='profile', default=None,
+      help='''Write the phase timings, CPU time and peak memory of this run as JSON to the
+report (a file, or a directory to add a file per run to). Defaults to ${0}.'''.format(PROFILE_ENV))
+
+  parser.add_argument( '--cprofile', metavar='stats', dest='cprofile', default=None,
+      help='''Also run cProfile, save its stats to this file and add the hottest functions
+to the report. Defaults to ${0}.'''.format(CPROFILE_ENV))
+
+def start(tool, report=None, cprofile=None):
+  ''' Start profiling the run if a report (or $HACKS_PROFILE) is given, the
+  report is written when the process exits. Returns the profile, or None. '''
+  global _profile
+  report   = report or os.environ.get(PROFILE_ENV)
+  cprofile = cprofile or os.environ.get(CPROFILE_ENV)
+  if not report:
+    if cprofile:
+      report = "{0}.json".format(cprofile)
+    else:
+      return None
+
+  if _profile is None:
+    _profile = Profile(tool, report, cprofile)
+    atexit.register(_profile.stop)
+  return _profile
+
+@contextmanager
+def phase(name):
+  ''' Time the block as part of the named phase, if profiling. '''
+  if _profile is None:
+    yield
+    return
+
+  begin = time.time()
+  try:
+    yield
+  finally:
+    _profile.add(name, time.time() - begin)
+
+def timed(name):
+  ''' Decorator, time every call of the function as part of the named phase. '''
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if _profile is None:
+        return func(*args, **kwargs)
+      with phase(name):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
@@ -0,0 +1,94 @@
+''' Input fingerprints for the CSV hacks.
+
+Each stage records the content hashes of its inputs (and arguments) and of the
+outputs it left behind in a small JSON manifest. When a stage is run again with
+the same inputs and its outputs are still the ones it wrote, it is skipped
+without parsing or rewriting anything.
+
+The CSV is both an input and an output of every stage, its input hash is the
+CSV as the stage wrote it (the stages are idempotent). When a stage rewrites
+the CSV, the other stages that were up to date with the previous content are
+moved on to the new one, so a chain of stages is up to date with the CSV the
+last one wrote.
+'''
+
+import hashlib
+import json
+import os
+import sys
+import profiling
+
+MANIFEST_ENV="HACKS_STAGE_MANIFEST"
+MANIFEST="{0}/../build/_output/csv-stages.json".format(os.path.dirname(os.path.realpath(__file__)))
+
+def fileHash(path):
+  ''' The sha256 of the file content, None if it does not exist. '''
+  sha = hashlib.sha256()
+  try:
+    with open(path, 'rb') as stream:
+      for chunk in iter(lambda: stream.read(1 << 20), b''):
+        sha.update(chunk)
+  except (IOError, OSError):
+    return None
+  return sha.hexdigest()
+
+class Stage(object):
+  ''' The fingerprint of one stage run against one CSV. '''
+
+  def __init__(self, name, inputs, outputs, params=(), manifest=None):
+    self.manifest = manifest or os.environ.get(MANIFEST_ENV) or MANIFEST
+    self.inputs   = [ path for path in inputs if path is not None ]
+    self.outputs  = [ path for path in outputs if path is not None ]
+    self.name     = "{0}:{1}".format(name, os.path.realpath(self.outputs[0]))
+    self.params   = hashlib.sha256(json.dumps(list(params)).encode("utf-8")).hexdigest()
+    # The outputs as the stage found them, to move the other stages along in record().
+    self.before   = self._hashes(self.outputs)
+
+  @staticmethod
+  def _hashes(paths):
+    return dict((os.path.realpath(path), fileHash(path)) for path in paths)
+
+  def _load(self):
+    try:
+      with open(self.manifest, 'r') as stream:
+        return json.load(stream)
+    except (IOError, OSError, ValueError):
+      return {}
+
+  @profiling.timed("fingerprint")
+  def upToDate(self):
+    ''' True if the stage already ran on these inputs and its outputs are unchanged. '''
+    entry = self._load().get(self.name)
+    return (entry is not None and entry.get("params") == self.params
+            and entry.get("inputs") == self._hashes(self.inputs)
+            and entry.get("outputs") == self._hashes(self.outputs))
+
+  @profiling.timed("fingerprint")
+  def record(self):
+    ''' Save the inputs and outputs as the stage left them, and move the stages that
+    were up to date with the outputs it rewrote on to the new content. '''
+    manifest = self._load()
+    after    = self._hashes(self.outputs)
+    for path, old in self.before.items():
+      if old is None or after[path] == old:
+        continue
+      for name, entry in manifest.items():
+        recorded = [ files for files in (entry.get("inputs", {}), entry.get("outputs", {}))
+                     if path in files ]
+        if recorded and all(files[path] == old for files in recorded):
+          for files in recorded:
+            files[path] = after[path]
+
+    manifest[self.name] = {
+      "params"  : self.params,
+      "inputs"  : self._hashes(self.inputs),
+      "outputs" : after }
+
+    try:
+      os.makedirs(os.path.dirname(self.manifest), exist_ok=True)
+      tmp = "{0}.{1}".format(self.manifest, os.getpid())
+      with open(tmp, 'w') as stream:
+        json.dump(manifest, stream, indent=2, sort_keys=True)
+      os.replace(tmp, self.manifest)
+    except (IOError, OSError) as e:
+      sys.stderr.write("Unable to update {0}: {1}\n".format(self.manifest, e))
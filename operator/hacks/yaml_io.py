@@ -0,0 +1,145 @@
+''' Shared YAML loading and dumping for the operator hacks.
+
+The libyaml (C) loader and dumper are used when PyYAML was built with them,
+otherwise the pure Python ones. Setting HACKS_YAML_CACHE to a directory keeps
+the parsed documents there, so unchanged CRDs, CRs and CSVs are not parsed
+again on the next run. The cache hit rate and parse time saved are reported
+on stderr when the process exits.
+'''
+
+import atexit
+import glob
+import hashlib
+import os
+import pickle
+import sys
+import threading
+import time
+import yaml
+import profiling
+from concurrent.futures import ThreadPoolExecutor
+
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+Dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+CACHE_ENV="HACKS_YAML_CACHE"
+
+_stats = { "hits": 0, "misses": 0, "saved": 0.0 }
+_stats_lock = threading.Lock()
+
+def loads(content):
+  ''' Parse a YAML document from a string. '''
+  return yaml.load(content, Loader=Loader)
+
+@profiling.timed("dump")
+def dumps(obj):
+  ''' Emit the object as block style YAML. '''
+  return yaml.dump(obj, Dumper=Dumper, default_flow_style=False)
+
+def dump(obj, path):
+  ''' Write the object to the path as block style YAML. The file is left alone
+  (and keeps its mtime) if the content is unchanged, returns True if written. '''
+  content = dumps(obj)
+  try:
+    with open(path, 'r') as stream:
+      if stream.read() == content:
+        return False
+  except (IOError, OSError):
+    pass
+
+  with profiling.phase("write"), open(path, 'w') as outfile:
+    outfile.write(content)
+  return True
+
+@profiling.timed("load")
+def load(path):
+  ''' Parse the YAML document at the path, from the cache if it is enabled and
+  the file (size, mtime and content) is unchanged. '''
+  cachedir = os.environ.get(CACHE_ENV)
+  if not cachedir:
+    with open(path, 'r') as stream:
+      return yaml.load(stream, Loader=Loader)
+
+  with open(path, 'rb') as stream:
+    content = stream.read()
+
+  st     = os.stat(path)
+  digest = hashlib.sha256(content).hexdigest()
+  entry  = "{0}/{1}.pickle".format(cachedir,
+    hashlib.sha256(os.path.realpath(path).encode("utf-8")).hexdigest())
+
+  start = time.time()
+  try:
+    with open(entry, 'rb') as stream:
+      cached = pickle.load(stream)
+    if (cached["size"], cached["mtime"], cached["sha256"]) == (st.st_size, st.st_mtime, digest):
+      _record(hit=True, saved=cached["parse"] - (time.time() - start))
+      return cached["obj"]
+  except (IOError, OSError, EOFError, KeyError, pickle.UnpicklingError):
+    pass
+
+  start = time.time()
+  obj   = loads(content.decode("utf-8"))
+  parse = time.time() - start
+  _record(hit=False)
+
+  try:
+    os.makedirs(cachedir, exist_ok=True)
+    tmp = "{0}.{1}".format(entry, os.getpid())
+    with open(tmp, 'wb') as stream:
+      pickle.dump({ "size": st.st_size, "mtime": st.st_mtime, "sha256": digest,
+                    "parse": parse, "obj": obj }, stream, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, entry)
+  except (IOError, OSError) as e:
+    sys.stderr.write("Unable to cache {0}: {1}\n".format(path, e))
+
+  return obj
+
+def loadAll(paths, workers=None):
+  ''' Parse the YAML documents at the paths, in threads if there is more than
+  one (the reads and cache lookups overlap). Returns them in the order of the
+  paths. '''
+  if len(paths) < 2:
+    return [ load(path) for path in paths ]
+
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(load, paths))
+
+def expandPaths(patterns, base=""):
+  ''' The files of the patterns, each a file, a glob or a directory (its .yaml
+  files), relative to base unless absolute. Sorted per pattern, no duplicates. '''
+  paths = []
+  for pattern in patterns:
+    pattern = pattern if os.path.isabs(pattern) else "{0}{1}".format(base, pattern)
+    if os.path.isdir(pattern):
+      matches = sorted(glob.glob(os.path.join(pattern, "*.yaml")))
+    elif glob.has_magic(pattern):
+      matches = sorted(glob.glob(pattern))
+    else:
+      matches = [ pattern ]
+
+    for path in matches:
+      if path not in paths:
+        paths.append(path)
+  return paths
+
+def stats():
+  ''' The cache hits, misses and parse time saved (in seconds) so far. '''
+  with _stats_lock:
+    return dict(_stats)
+
+def _record(hit, saved=0.0):
+  with _stats_lock:
+    if _stats["hits"] + _stats["misses"] == 0:
+      atexit.register(_report)
+
+    if hit:
+      _stats["hits"]  += 1
+      _stats["saved"] += max(saved, 0.0)
+    else:
+      _stats["misses"] += 1
+
+def _report():
+  total = _stats["hits"] + _stats["misses"]
+  sys.stderr.write("yaml cache: {0}/{1} hits ({2:.0f}%), {3:.3f}s parse time saved\n".format(
+    _stats["hits"], total, 100.0 * _stats["hits"] / total, _stats["saved"]))
@@ -0,0 +1,310 @@
+#!/bin/python
+
+import argparse
+import importlib.util
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# The benchmark lives outside of hacks, which is copied to every cluster node.
+SCRIPT_DIR=os.path.dirname(os.path.realpath(__file__))
+HACKS_DIR=os.path.join(SCRIPT_DIR, "..", "hacks")
+SCRAPER="{0}/deploycsioperator.py".format(HACKS_DIR)
+
+DEFAULT_NODES="10,1000,10000,100000"
+DEFAULT_FILESYSTEMS="1,50,500"
+DEFAULT_TOLERANCE=0.5
+
+# The metrics compared against the baseline, with the absolute slack (seconds or
+# MB) allowed on top of the tolerance so noise on tiny sizes is not a regression.
+METRICS={
+  "parse_stream"  : 0.05,
+  "parse_textfsm" : 0.05,
+  "parse_mmlsfs"  : 0.05,
+  "wall"          : 0.25,
+  "rss_mb"        : 5.0 }
+
+# Absolute limits checked on every run, so a regression fails even without a
+# baseline: (base, per node, per filesystem) in seconds or MB. They are several
+# times the measured cost (about 3.5us per node streamed, 15us per node with
+# TextFSM, 30us per node end-to-end and 1KB per node of RSS) to absorb slow and
+# noisy machines.
+LIMITS={
+  "parse_stream"  : (0.05, 20e-6,  0),
+  "parse_textfsm" : (0.10, 80e-6,  0),
+  "parse_mmlsfs"  : (0.05, 0,      100e-6),
+  "wall"          : (2.0,  150e-6, 1e-3),
+  "rss_mb"        : (100,  0.005,  0.02) }
+
+DESIGNATIONS=("quorum-manager", "quorum", "manager", "perfmon", "")
+
+
+def load_scraper():
+  ''' Import deploycsioperator.py so the parsers can be timed in-process. '''
+  spec = importlib.util.spec_from_file_location("deploycsioperator", SCRAPER)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def gen_mmlscluster(nodes):
+  ''' Synthetic mmlscluster output, every fifth node has no designation. '''
+  lines = [
+    "",
+    "GPFS cluster information",
+    "========================",
+    "  GPFS cluster name:         bench.example.com",
+    "  GPFS cluster id:           12399838388936568191",
+    "  GPFS UID domain:           bench.example.com",
+    "  Remote shell command:      /usr/bin/ssh",
+    "  Remote file copy command:  /usr/bin/scp",
+    "  Repository type:           CCR",
+    "",
+    " Node  Daemon node name            IP address       Admin node name             Designation",
+    "-------------------------------------------------------------------------------------------" ]
+
+  for i in range(1, nodes + 1):
+    name = "node{0:06d}.bench.example.com".format(i)
+    address = "10.{0}.{1}.{2}".format(i >> 16 & 255, i >> 8 & 255, i & 255)
+    lines.append(" {0:>5}   {1:<27} {2:<16} {1:<27} {3}".format(
+      i, name, address, DESIGNATIONS[i % len(DESIGNATIONS)]).rstrip())
+
+  return "\n".join(lines) + "\n"
+
+
+def gen_mmlsnodeclass(nodes):
+  ''' Synthetic mmlsnodeclass GUI_MGMT_SERVERS output. '''
+  guis = ",".join("node{0:06d}.bench.example.com".format(i) for i in range(1, min(nodes, 3) + 1))
+  return "\n".join([
+    "Node Class Name       Members",
+    "--------------------- -----------------------------------------------------------",
+    "GUI_MGMT_SERVERS      {0}".format(guis) ]) + "\n"
+
+
+def gen_mmlsfs(filesystems):
+  ''' Synthetic mmlsfs all -T output. '''
+  blocks = []
+  for i in range(1, filesystems + 1):
+    blocks.append("\n".join([
+      "File system attributes for /dev/fs{0}:".format(i),
+      "======================================",
+      "flag                value                    description",
+      "------------------- ------------------------ -----------------------------------",
+      " -T                 /ibm/fs{0:<20} Default mount point".format(i),
+      "" ]))
+
+  return "\n".join(blocks)
+
+
+def fake_commands(workdir, nodes, filesystems):
+  ''' Write the synthetic outputs and fake mm* executables that print them. '''
+  commands = {}
+  outputs = {
+    "mmlscluster"   : gen_mmlscluster(nodes),
+    "mmlsnodeclass" : gen_mmlsnodeclass(nodes),
+    "mmlsfs"        : gen_mmlsfs(filesystems) }
+
+  for name, output in outputs.items():
+    data = "{0}/{1}.out".format(workdir, name)
+    with open(data, "w") as stream:
+      stream.write(output)
+
+    cmd = "{0}/{1}".format(workdir, name)
+    with open(cmd, "w") as stream:
+      stream.write("#!/bin/sh\nexec cat {0}\n".format(data))
+    os.chmod(cmd, 0o755)
+    commands[name] = cmd
+
+  return commands, outputs
+
+
+def timed(func, *args):
+  start = time.perf_counter()
+  result = func(*args)
+  return result, time.perf_counter() - start
+
+
+def run_main(scraper, commands, parser):
+  ''' Run the scraper end-to-end in a child process, returns the wall time and
+  the peak RSS of the child in MB. '''
+  cmd = [ sys.executable, SCRAPER, "--no-cache", "--parser", parser,
+          "--templates", HACKS_DIR,
+          "--mmlscluster",   commands["mmlscluster"],
+          "--mmlsnodeclass", commands["mmlsnodeclass"],
+          "--mmlsfs",        commands["mmlsfs"] ]
+
+  # stderr goes to a file, a pipe nobody reads until the child exits could fill up.
+  with tempfile.TemporaryFile() as errf:
+    start = time.perf_counter()
+    p = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=errf)
+    _, status, rusage = os.wait4(p.pid, 0)
+    wall = time.perf_counter() - start
+    errf.seek(0)
+    err = errf.read().decode("utf-8", "replace")
+
+  if status != 0:
+    raise RuntimeError("scraper failed: {0}".format(err.strip()))
+
+  # ru_maxrss is in KB on Linux.
+  return wall, rusage.ru_maxrss / 1024.0
+
+
+def bench(scraper, workdir, nodes, filesystems, parser, skip_textfsm):
+  ''' Benchmark a single size, returns the measured metrics. '''
+  commands, outputs = fake_commands(workdir, nodes, filesystems)
+  templates = "{0}/templates".format(HACKS_DIR)
+  result = { "nodes": nodes, "filesystems": filesystems }
+
+  cluster = scraper.new_cluster()
+  def stream_parse():
+    for row in scraper.parse_mmlscluster(outputs["mmlscluster"].splitlines(True), cluster):
+      scraper.add_node(cluster, *row)
+    return cluster
+  streamed, result["parse_stream"] = timed(stream_parse)
+  # Parity alone misses rows both parsers drop, every generated node must be found.
+  result["parsed_nodes"] = len(streamed["nodes"])
+
+  if not skip_textfsm:
+    # Compile the template outside of the timed parse.
+    scraper.parse("{0}/mmlscluster".format(templates), "")
+    (header, data), result["parse_textfsm"] = timed(scraper.parse,
+      "{0}/mmlscluster".format(templates), outputs["mmlscluster"])
+
+    fsmcluster = scraper.new_cluster()
+    zipped = {}
+    for row in data:
+      zipped = dict(zip(header, row))
+      if zipped.get("Node"):
+        scraper.add_node(fsmcluster, zipped["Node"], zipped["Address"],
+          zipped["Admin"], zipped["Designation"])
+    fsmcluster["id"]   = zipped.get("ID")
+    fsmcluster["name"] = zipped.get("Name")
+    result["parity"] = fsmcluster == streamed
+
+  _, result["parse_mmlsfs"] = timed(scraper.parse,
+    "{0}/mmlsfs".format(templates), outputs["mmlsfs"])
+
+  result["wall"], result["rss_mb"] = run_main(scraper, commands, parser)
+
+  return result
+
+
+def limit(metric, nodes, filesystems):
+  ''' The absolute limit of the metric for a size. '''
+  base, pernode, perfs = LIMITS[metric]
+  return base + pernode * nodes + perfs * filesystems
+
+
+def regressions(results, baseline, tolerance, limits=True):
+  ''' Compare the results with the absolute limits and the baseline, returns a
+  list of regressions. '''
+  found = []
+  for result in results:
+    key = "{nodes}x{filesystems}".format(**result)
+    for metric in sorted(LIMITS):
+      current = result.get(metric)
+      if not limits or current is None:
+        continue
+      maximum = limit(metric, result["nodes"], result["filesystems"])
+      if current > maximum:
+        found.append("{0} {1}: {2:.4f} > limit {3:.4f}".format(key, metric, current, maximum))
+
+    for metric, slack in sorted(METRICS.items()):
+      previous = baseline.get(key, {}).get(metric)
+      current  = result.get(metric)
+      if previous is None or current is None:
+        continue
+      if current > previous * (1 + tolerance) + slack:
+        found.append("{0} {1}: {2:.4f} > {3:.4f} (+{4:.0f}%)".format(key, metric,
+          current, previous, (current / previous - 1) * 100 if previous else 0))
+
+    if result["parsed_nodes"] != result["nodes"]:
+      found.append("{0}: the stream parser found {1} of {2} nodes".format(key,
+        result["parsed_nodes"], result["nodes"]))
+
+    if result.get("parity") is False:
+      found.append("{0}: the stream and textfsm parsers disagree".format(key))
+
+  return found
+
+
+def main(args):
+  parser = argparse.ArgumentParser(
+      description='''Benchmark deploycsioperator.py against synthetic mm* output served by fake
+executables. Reports parse time, peak RSS and end-to-end wall time for each size, and
+fails if a metric exceeds its built-in limit or regressed from the --baseline.''')
+
+  parser.add_argument( '--nodes', metavar='nodes', dest='nodes',
+      default=DEFAULT_NODES,
+      help='''Comma separated node counts to benchmark.''')
+  parser.add_argument( '--filesystems', metavar='filesystems', dest='filesystems',
+      default=DEFAULT_FILESYSTEMS,
+      help='''Comma separated filesystem counts to benchmark (each is run with every node count).''')
+  parser.add_argument( '--parser', dest='parser', choices=["stream", "textfsm"],
+      default="stream",
+      help='''The mmlscluster parser used for the end-to-end runs.''')
+  parser.add_argument( '--skip-textfsm', dest='skiptextfsm', action='store_true',
+      help='''Skip timing the TextFSM mmlscluster parser (and the parity check).''')
+  parser.add_argument( '--baseline', metavar='baseline', dest='baseline', default=None,
+      help='''A JSON file of previous results, fail if a metric regressed past the tolerance.''')
+  parser.add_argument( '--update-baseline', dest='update', action='store_true',
+      help='''Write the results to the --baseline file instead of comparing them.''')
+  parser.add_argument( '--tolerance', metavar='fraction', dest='tolerance',
+      type=float, default=DEFAULT_TOLERANCE,
+      help='''How much slower (or larger) than the baseline a metric may be, 0.5 is 50%%.''')
+  parser.add_argument( '--no-limits', dest='nolimits', action='store_true',
+      help='''Only compare with the --baseline, not with the built-in absolute limits.''')
+  parser.add_argument( '--json', metavar='report', dest='report', default=None,
+      help='''Also write the results to this JSON file.''')
+
+  args = parser.parse_args()
+
+  sizes = [ (int(n), int(f)) for n in args.nodes.split(",")
+                             for f in args.filesystems.split(",") ]
+
+  scraper = load_scraper()
+  workdir = tempfile.mkdtemp(prefix="bench-scraper-")
+  results = []
+  try:
+    print("{0:>8} {1:>5} {2:>10} {3:>10} {4:>10} {5:>9} {6:>9} {7:>6}".format(
+      "nodes", "fs", "stream(s)", "textfsm(s)", "mmlsfs(s)", "wall(s)", "rss(MB)", "parity"))
+    for nodes, filesystems in sizes:
+      result = bench(scraper, workdir, nodes, filesystems, args.parser, args.skiptextfsm)
+      results.append(result)
+      print("{nodes:>8} {filesystems:>5} {0:>10.4f} {1:>10} {2:>10.4f} {3:>9.3f} {4:>9.1f} {5:>6}".format(
+        result["parse_stream"],
+        "{0:.4f}".format(result["parse_textfsm"]) if "parse_textfsm" in result else "-",
+        result["parse_mmlsfs"], result["wall"], result["rss_mb"],
+        { True: "ok", False: "FAIL" }.get(result.get("parity"), "-"), **result))
+      sys.stdout.flush()
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  if args.report is not None:
+    with open(args.report, "w") as stream:
+      json.dump(results, stream, indent=2)
+
+  if args.baseline is not None and args.update:
+    with open(args.baseline, "w") as stream:
+      json.dump(dict(("{nodes}x{filesystems}".format(**result), result)
+        for result in results), stream, indent=2, sort_keys=True)
+    print("Baseline written to {0}".format(args.baseline))
+    return 0
+
+  baseline = {}
+  if args.baseline is not None:
+    with open(args.baseline, "r") as stream:
+      baseline = json.load(stream)
+
+  found = regressions(results, baseline, args.tolerance, not args.nolimits)
+  for regression in found:
+    print("REGRESSION {0}".format(regression))
+
+  return 1 if found else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -1,122 +1,771 @@
 #!/bin/python
 
 import argparse
+import hashlib
+import json
 import sys
 import os
+import re
+import shlex
+import signal
+import tempfile
+import time
+import threading
 import yaml
 import subprocess
 import textfsm
+import profiling
+from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# Compiled TextFSM parsers, keyed by template path. A parser carries its own
+# state, so each one is checked out by a single probe at a time and handed
+# back once the output is parsed.
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
 
-def mmlscluster(cmd, tmpl):
-  ''' Run the mmlscluster command and grab the relevant data '''
+# The streaming mmlscluster parser, these mirror the rules in templates/mmlscluster.
+MMLSCLUSTER_NAME = re.compile(r"\s+GPFS cluster name:\s+([^\s]+)")
+MMLSCLUSTER_ID   = re.compile(r"\s+GPFS cluster id:\s+(\d+)")
+# A client node has no designation.
+MMLSCLUSTER_NODE = re.compile(r"\s+\d+\s+([^\s]+)\s+([^\s]+)\s+([^\s]+)(?:\s+([\w-]+))?\s*$")
+
+# The mmlsnodeclass table starts after the dashed line under its header.
+MMLSNODECLASS_RULE = re.compile(r"^-+\s+-+\s*$")
+
+GUI_CLASS = "GUI_MGMT_SERVERS"
+
+# The mmlsfs -Y field holding the mount point (the -T attribute).
+MMLSFS_MOUNT = "defaultMountPoint"
+
+CACHE_DIR="{0}/ibm-spectrum-scale-csi/scraper".format(
+  os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")))
+
+
+class ProbeError(Exception):
+  ''' Raised when an mm* command fails to run or exceeds its timeout. '''
+  pass
+
+
+@profiling.timed("parse")
+def parse(tmpl, out):
+  ''' Parse the output with the compiled template, returns the header and rows. '''
+  with _TEMPLATES_LOCK:
+    idle = _TEMPLATES.setdefault(tmpl, [])
+    re_table = idle.pop() if idle else None
+
+  if re_table is None:
+    with open(tmpl, "r") as template:
+      re_table = textfsm.TextFSM(template)
+
+  try:
+    re_table.Reset()
+    return re_table.header, re_table.ParseText(out)
+  finally:
+    with _TEMPLATES_LOCK:
+      _TEMPLATES[tmpl].append(re_table)
+
+
+class ProbeCache(object):
+  ''' An on-disk cache of probe results. Entries are keyed by the probe, the
+  command it runs and the template it is parsed with, so a changed template
+  invalidates them. Entries older than the TTL are misses, unless stale results
+  may be served while a background refresh replaces them. '''
+
+  def __init__(self, path, ttl, stale=False, refresh=False):
+    self.path       = path
+    self.ttl        = ttl
+    self.stale      = stale
+    self.refresh    = refresh
+    self.revalidate = False
+    self.stats      = { "hit": 0, "miss": 0, "stale": 0 }
+    self.lock       = threading.Lock()
+    self.templates  = {}
+
+  def template(self, tmpl):
+    ''' Hash the template content, cached on the path and mtime. '''
+    mtime = os.stat(tmpl).st_mtime
+    with self.lock:
+      cached = self.templates.get(tmpl)
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+
+    with open(tmpl, "rb") as template:
+      digest = hashlib.sha256(template.read()).hexdigest()
+    with self.lock:
+      self.templates[tmpl] = (mtime, digest)
+    return digest
+
+  def key(self, func, cmd, tmpl):
+    key = json.dumps([func.__name__, cmd, tmpl, self.template(tmpl)])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+  def count(self, stat):
+    with self.lock:
+      self.stats[stat] += 1
+
+  @profiling.timed("cache")
+  def get(self, key):
+    ''' Returns the cached result or None on a miss. '''
+    entry = None
+    if not self.refresh:
+      try:
+        with open("{0}/{1}.json".format(self.path, key), "r") as stream:
+          entry = json.load(stream)
+      except (IOError, OSError, ValueError):
+        entry = None
+
+    if entry is None:
+      self.count("miss")
+      return None
+
+    if time.time() - entry["time"] < self.ttl:
+      self.count("hit")
+      return entry["result"]
+
+    if self.stale:
+      self.count("stale")
+      self.revalidate = True
+      return entry["result"]
+
+    self.count("miss")
+    return None
+
+  @profiling.timed("cache")
+  def put(self, key, result):
+    ''' Write the entry atomically, a failed write only costs a future miss. '''
+    target = "{0}/{1}.json".format(self.path, key)
+    tmp    = "{0}.{1}.{2}".format(target, os.getpid(), threading.current_thread().ident)
+    try:
+      os.makedirs(self.path, exist_ok=True)
+      with open(tmp, "w") as stream:
+        json.dump({ "time": time.time(), "result": result }, stream)
+      os.replace(tmp, target)
+    except (IOError, OSError) as e:
+      sys.stderr.write("Unable to cache probe result: {0}\n".format(e))
+
+  def revalidate_in_background(self, argv):
+    ''' Rerun the scraper with --refresh in a detached process, unless another
+    refresh started within the TTL is still running. '''
+    lock = "{0}/refresh.lock".format(self.path)
+    try:
+      if time.time() - os.stat(lock).st_mtime > self.ttl:
+        os.remove(lock)
+    except OSError:
+      pass
+
+    try:
+      os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except OSError:
+      return
+
+    devnull = open(os.devnull, "r+")
+    subprocess.Popen([sys.executable, os.path.realpath(__file__)] + argv + ["--refresh"],
+      stdin=devnull, stdout=devnull, stderr=devnull, start_new_session=True)
+
+  def release(self):
+    ''' Drop the background refresh lock (if any). '''
+    try:
+      os.remove("{0}/refresh.lock".format(self.path))
+    except OSError:
+      pass
+
+
+def kill(p):
+  ''' Kill the command and everything it started. The command runs in its own
+  session, so a wrapper script cannot leave a child behind holding its output
+  open. '''
+  try:
+    os.killpg(p.pid, signal.SIGKILL)
+  except OSError:
+    pass
+
+
+@profiling.timed("subprocess")
+def run(cmd, timeout=None, check=True):
+  ''' Run an mm* command and return its stdout as text. With check a non-zero
+  exit status (e.g. an unreachable cluster behind an ssh prefix) is an error. '''
+  try:
+    p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True, start_new_session=True)
+  except OSError as e:
+    raise ProbeError("'{0}' could not be run: {1}".format(cmd[0], e))
+
+  try:
+    out, err = p.communicate(timeout=timeout)
+  except subprocess.TimeoutExpired:
+    kill(p)
+    p.communicate()
+    raise ProbeError("'{0}' timed out after {1}s".format(" ".join(cmd), timeout))
+
+  if check and p.returncode != 0:
+    raise ProbeError("'{0}' exited with {1}: {2}".format(" ".join(cmd),
+      p.returncode, err.strip()))
 
-  p = subprocess.Popen([cmd], stdout=subprocess.PIPE, 
-                              stderr=subprocess.PIPE)
-  out, err = p.communicate()
+  return out
 
-  output = {
+
+def stream(cmd, timeout=None):
+  ''' Run an mm* command, yielding its stdout line by line as it is written. '''
+  with tempfile.TemporaryFile(mode="w+") as errf:
+    try:
+      p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=errf,
+                                universal_newlines=True, start_new_session=True)
+    except OSError as e:
+      raise ProbeError("'{0}' could not be run: {1}".format(cmd[0], e))
+
+    expired = threading.Event()
+    def expire():
+      expired.set()
+      kill(p)
+
+    timer = threading.Timer(timeout, expire) if timeout is not None else None
+    if timer is not None:
+      timer.start()
+
+    try:
+      for line in p.stdout:
+        yield line
+      p.wait()
+    finally:
+      if timer is not None:
+        timer.cancel()
+      if p.poll() is None:
+        kill(p)
+        p.wait()
+      p.stdout.close()
+
+    if expired.is_set():
+      raise ProbeError("'{0}' timed out after {1}s".format(" ".join(cmd), timeout))
+
+    if p.returncode != 0:
+      errf.seek(0)
+      raise ProbeError("'{0}' exited with {1}: {2}".format(" ".join(cmd),
+        p.returncode, errf.read().strip()))
+
+
+def new_cluster():
+  ''' The mmlscluster facts, nodes are stored as columns (one list per field). '''
+  return {
       "id": None,
       "name": None,
-      "nodes":[] 
+      "nodes":[],
+      "addresses":[],
+      "admin_nodes":[],
+      "designations":[]
   }
-  with open(tmpl,"r") as template:
-    re_table = textfsm.TextFSM(template)
-    data = re_table.ParseText(out)
 
-    zipped = dict()
-    for row in data:
-      zipped = dict(zip(re_table.header, row))
-      node = zipped.get("Node", None)
-      if node is not None and isinstance(node, str):
-          output["nodes"].append(node)
-    
-    output["id"]   = zipped.get("ID")
-    output["name"] = zipped.get("Name")
+def add_node(output, node, address, admin, designation):
+  output["nodes"].append(node)
+  output["addresses"].append(address)
+  output["admin_nodes"].append(admin)
+  output["designations"].append(designation)
+
+def mmlscluster(cmd, tmpl, timeout=None, prefix=()):
+  ''' Run the mmlscluster command and grab the relevant data '''
+
+  out = run(list(prefix) + [cmd], timeout)
+
+  output = new_cluster()
+  header, data = parse(tmpl, out)
+
+  zipped = dict()
+  for row in data:
+    zipped = dict(zip(header, row))
+    node = zipped.get("Node", None)
+    # The implicit EOF record only carries the filled down ID and Name.
+    if node:
+      add_node(output, node, zipped.get("Address"), zipped.get("Admin"),
+        zipped.get("Designation"))
+
+  output["id"]   = zipped.get("ID")
+  output["name"] = zipped.get("Name")
+
+  return output
+
+def parse_mmlscluster(lines, output):
+  ''' Parse mmlscluster output as it arrives, the cluster name and id are set on
+  the output and each node row is yielded as soon as it is read. '''
+  for line in lines:
+    match = MMLSCLUSTER_NAME.match(line)
+    if match:
+      output["name"] = match.group(1)
+      continue
 
-    return output
+    match = MMLSCLUSTER_ID.match(line)
+    if match:
+      output["id"] = match.group(1)
+      continue
 
-def mmlsgui(cmd, tmpl):
+    match = MMLSCLUSTER_NODE.match(line)
+    if match:
+      node, address, admin, designation = match.groups()
+      yield node, address, admin, designation or ""
+
+@profiling.timed("subprocess")
+def mmlscluster_stream(cmd, tmpl, timeout=None, prefix=()):
+  ''' Run the mmlscluster command and parse the node table while it is read,
+  without holding the full output. Yields the same results as mmlscluster. '''
+  output = new_cluster()
+  for node, address, admin, designation in parse_mmlscluster(
+      stream(list(prefix) + [cmd], timeout), output):
+    add_node(output, node, address, admin, designation)
+
+  return output
+
+def mmlsgui(cmd, tmpl, timeout=None, prefix=()):
   ''' Run mmlsnodeclass GUI_MGMT_SERVERS, return the first instance found. '''
-   
-  p = subprocess.Popen([cmd, "GUI_MGMT_SERVERS"], stdout=subprocess.PIPE,
-                                                  stderr=subprocess.PIPE)
-  out, err = p.communicate()
-  
-  with open(tmpl,"r") as template:
-    re_table = textfsm.TextFSM(template)
-    data = re_table.ParseText(out)
-      
-    zipped = dict()
-    for row in data:
-      zipped = dict(zip(re_table.header, row))
-      gui = zipped.get("GUI_MGMT_SERVER", None)
-      if gui is not None and isinstance(gui, str):
-        return gui
+
+  # A cluster without the node class is not an error, there is just no GUI.
+  out = run(list(prefix) + [cmd, "GUI_MGMT_SERVERS"], timeout, check=False)
+
+  header, data = parse(tmpl, out)
+
+  zipped = dict()
+  for row in data:
+    zipped = dict(zip(header, row))
+    gui = zipped.get("GUI_MGMT_SERVER", None)
+    if gui is not None and isinstance(gui, str):
+      return gui
 
   return ""
 
-def mmlsfs(cmd, tmpl):
-  ''' Run the mmlsfs command and grab the relevant data. '''
-  p = subprocess.Popen([cmd, "all", "-T"], 
-    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-  out, err = p.communicate()
+def parse_mmlsnodeclass(lines):
+  ''' Parse mmlsnodeclass output as it arrives, yielding each class and its
+  members. A long member list wraps onto indented continuation lines. '''
+  table = False
+  name  = None
+  members = []
+  for line in lines:
+    if not table:
+      table = MMLSNODECLASS_RULE.match(line) is not None
+      continue
+
+    if not line.strip():
+      continue
+
+    if line[0].isspace():
+      # A continuation of the member list of the current class.
+      if name is not None:
+        members.append(line.strip())
+      continue
+
+    if name is not None:
+      yield name, split_members(members)
+    fields  = line.split(None, 1)
+    name    = fields[0]
+    members = fields[1:]
+
+  if name is not None:
+    yield name, split_members(members)
+
+def split_members(fragments):
+  ''' The nodes of a (wrapped) comma separated member list. '''
+  return [ node for node in "".join(f.strip() for f in fragments).split(",") if node ]
+
+@profiling.timed("subprocess")
+def mmlsnodeclasses(cmd, tmpl, timeout=None, prefix=()):
+  ''' Run mmlsnodeclass --all once and index every node class, returns the
+  class -> nodes and node -> classes indexes and all of the GUI servers. '''
+  classes = {}
+  nodes   = {}
+  for name, members in parse_mmlsnodeclass(stream(list(prefix) + [cmd, "--all"], timeout)):
+    classes[name] = members
+    for node in members:
+      nodes.setdefault(node, []).append(name)
+
+  return {
+      "classes" : classes,
+      "nodes"   : nodes,
+      "gui"     : list(classes.get(GUI_CLASS, []))
+  }
+
+def mmlsfs(cmd, tmpl, timeout=None, prefix=(), devices=None):
+  ''' Run the mmlsfs command and grab the relevant data. Only the devices are
+  queried if they are supplied. '''
+  # The output of a single device has no "File system attributes for" header,
+  # so its rows are named after the device they were queried for.
+  if devices:
+    outputs = [ (device, run(list(prefix) + [cmd, device, "-T"], timeout)) for device in devices ]
+  else:
+    outputs = [ ("", run(list(prefix) + [cmd, "all", "-T"], timeout)) ]
 
   output=[]
-  with open(tmpl,"r") as template:
-    re_table = textfsm.TextFSM(template)
-    data = re_table.ParseText(out)
-      
-    zipped = dict()
+  for device, out in outputs:
+    header, data = parse(tmpl, out)
+
     for row in data:
-      zipped = dict(zip(re_table.header, row))
+      zipped = dict(zip(header, row))
 
       output.append({
-          "fs"    :  zipped.get("fs", ""),
+          "fs"    :  zipped.get("fs", "") or device,
           "mount" :  zipped.get("mount", "")
           })
 
-  return output 
+  return output
+
+def parse_mmlsfs(lines):
+  ''' Parse mmlsfs -Y output as it arrives, yielding the device and attributes
+  of each filesystem once its last line is read. An attribute with several
+  values (e.g. a block size per pool) becomes a list. '''
+  columns    = None
+  device     = None
+  attributes = {}
+  for line in lines:
+    fields = line.rstrip("\n").split(":")
+    if len(fields) < 3 or fields[0] != "mmlsfs":
+      continue
+
+    if fields[2] == "HEADER":
+      columns = dict((name, index) for index, name in enumerate(fields) if name)
+      continue
+    if columns is None:
+      continue
+
+    # The values are percent encoded, so a ':' in one does not split it.
+    row   = dict((column, unquote(fields[index])) for column, index in columns.items()
+                 if index < len(fields))
+    name  = row.get("deviceName", "")
+    field = row.get("fieldName", "")
+    if name != device:
+      if device is not None:
+        yield device, attributes
+      device     = name
+      attributes = {}
+
+    value = row.get("data", "")
+    if field not in attributes:
+      attributes[field] = value
+    elif isinstance(attributes[field], list):
+      attributes[field].append(value)
+    else:
+      attributes[field] = [attributes[field], value]
+
+  if device is not None:
+    yield device, attributes
+
+@profiling.timed("subprocess")
+def mmlsfs_attributes(cmd, tmpl, timeout=None, prefix=(), devices=None):
+  ''' Run mmlsfs all -Y once, returns the name, mount point and every attribute
+  of each filesystem. Only the devices are kept if they are supplied. '''
+  wanted = None
+  if devices:
+    wanted = set(device.split("/")[-1] for device in devices)
+
+  output = []
+  for device, attributes in parse_mmlsfs(stream(list(prefix) + [cmd, "all", "-Y"], timeout)):
+    if wanted is not None and device not in wanted:
+      continue
+
+    output.append({
+        "fs"         : device if device.startswith("/") else "/dev/{0}".format(device),
+        "mount"      : attributes.get(MMLSFS_MOUNT, ""),
+        "attributes" : attributes
+        })
+
+  return output
+
+def mmlsfileset(cmd, tmpl, timeout=None, prefix=(), devices=(), filesets=()):
+  ''' Run the mmlsfileset command for the filesets in each device. '''
+  output=[]
+  for device in devices:
+    out = run(list(prefix) + [cmd, device, ",".join(filesets)], timeout)
+    header, data = parse(tmpl, out)
+
+    for row in data:
+      zipped = dict(zip(header, row))
+      output.append({
+          "fs"      : device,
+          "fileset" : zipped.get("fileset", ""),
+          "status"  : zipped.get("status", ""),
+          "path"    : zipped.get("path", "")
+          })
+
+  return output
+
+
+def probe(func, cmd, tmpl, timeout=None, prefix=(), cache=None, extra=()):
+  ''' Run a single probe (or serve it from the cache), returns the result and the
+  wall-clock time it took. '''
+  start = time.time()
+  if cache is not None:
+    key = cache.key(func, list(prefix) + [cmd] + list(extra), tmpl)
+    result = cache.get(key)
+    if result is not None:
+      return result, time.time() - start
+
+  result = func(cmd, tmpl, timeout, prefix, *extra)
+  if cache is not None:
+    cache.put(key, result)
+
+  return result, time.time() - start
+
+
+def scrape(probes, concurrent=False, timeout=None, prefix=(), cache=None):
+  ''' Run the probes (name, func, cmd, tmpl, extra), either one after another or
+  all at once. Returns the results and wall-clock times keyed by probe name. '''
+  results = {}
+  timings = {}
+
+  if not concurrent:
+    for name, func, cmd, tmpl, extra in probes:
+      results[name], timings[name] = probe(func, cmd, tmpl, timeout, prefix, cache, extra)
+    return results, timings
+
+  with ThreadPoolExecutor(max_workers=len(probes)) as pool:
+    futures = [ (name, pool.submit(probe, func, cmd, tmpl, timeout, prefix, cache, extra))
+                for name, func, cmd, tmpl, extra in probes ]
+    for name, future in futures:
+      results[name], timings[name] = future.result()
+
+  return results, timings
+
+
+def cluster_probes(args, entry={}):
+  ''' Build the probe list, commands in an inventory entry override the arguments. '''
+  templates = "{0}/templates".format(args.templates)
+  clusterfunc = mmlscluster_stream if args.parser == "stream" else mmlscluster
+  guifunc     = mmlsnodeclasses if args.nodeclasses else mmlsgui
+  fsfunc      = mmlsfs_attributes if args.fsattributes else mmlsfs
+
+  probes = [
+    ("cluster", clusterfunc, entry.get("mmlscluster",   args.mmlscluster),
+      "{0}/mmlscluster".format(templates), ()),
+    ("gui",     guifunc,     entry.get("mmlsnodeclass", args.mmlsnodeclass),
+      "{0}/mmlsnodeclass".format(templates), ()),
+    ("fs",      fsfunc,      entry.get("mmlsfs",        args.mmlsfs),
+      "{0}/mmlsfs".format(templates), (args.fs,)) ]
+
+  if args.fset:
+    probes.append(
+      ("filesets", mmlsfileset, entry.get("mmlsfileset", args.mmlsfileset),
+        "{0}/mmlsfileset".format(templates), (args.fs, args.fset)))
+
+  return probes
+
+
+def scrape_cluster(probes, concurrent=False, timeout=None, prefix=(), cache=None):
+  ''' Scrape a single cluster, returns the cluster facts and the probe timings. '''
+  results, timings = scrape(probes, concurrent, timeout, prefix, cache)
+
+  cluster=results["cluster"]
+  if isinstance(results["gui"], dict):
+    # --nodeclasses, every GUI server and the node class indexes.
+    cluster["gui"]          = results["gui"]["gui"]
+    cluster["nodeclasses"]  = results["gui"]["classes"]
+    cluster["node_classes"] = results["gui"]["nodes"]
+  else:
+    cluster["gui"] = results["gui"]
+  cluster["fs"]  = results["fs"]
+  if "filesets" in results:
+    cluster["filesets"] = results["filesets"]
+
+  return cluster, timings
+
+
+@profiling.timed("load")
+def load_inventory(path):
+  ''' Load the cluster inventory, either a list of clusters or a "clusters" key.
+  Each cluster has a name, an optional command prefix (e.g. "ssh admin@host" or
+  "kubectl exec -n ibm-spectrum-scale pod --") and optional mm* command paths. '''
+  with open(path, "r") as stream:
+    inventory = yaml.safe_load(stream) or []
+
+  if isinstance(inventory, dict):
+    inventory = inventory.get("clusters", [])
+
+  clusters = []
+  for index, entry in enumerate(inventory):
+    prefix = entry.get("prefix", [])
+    if isinstance(prefix, str):
+      prefix = shlex.split(prefix)
+
+    entry = dict(entry, prefix=prefix)
+    entry.setdefault("name", "cluster{0}".format(index))
+    clusters.append(entry)
+
+  return clusters
+
+
+def collect(args, entry, cache=None):
+  ''' Scrape one inventory entry, failures are reported in the document. Any
+  failure (e.g. a cluster printing non UTF-8 output) only fails this entry, so
+  the documents of the other clusters are still written. '''
+  try:
+    cluster, timings = scrape_cluster(cluster_probes(args, entry),
+        args.concurrent, args.timeout, entry["prefix"], cache)
+  except (ProbeError, textfsm.TextFSMError) as e:
+    return { "inventory": entry["name"], "error": str(e) }, None
+  except Exception as e:
+    return { "inventory": entry["name"], "error": "{0}: {1}".format(type(e).__name__, e) }, None
+
+  cluster["inventory"] = entry["name"]
+  return cluster, timings
+
+
+@profiling.timed("dump")
+def emit(cluster, fmt="yaml", out=sys.stdout, explicit_start=False):
+  ''' Write the cluster facts as YAML (with libyaml if present), JSON or a single
+  line of JSON. '''
+  if fmt == "ndjson":
+    out.write(json.dumps(cluster, separators=(",", ":")))
+    out.write("\n")
+  elif fmt == "json":
+    json.dump(cluster, out, indent=2)
+    out.write("\n")
+  else:
+    yaml.dump(cluster, out, Dumper=getattr(yaml, "CSafeDumper", yaml.SafeDumper),
+      explicit_start=explicit_start)
+    if not explicit_start:
+      out.write("\n")
+
+  out.flush()
+
+
+def fanout(args, clusters, out=sys.stdout, cache=None):
+  ''' Scrape the clusters with a bounded pool, a document is written for each
+  cluster as soon as it finishes. Returns the number of clusters that failed. '''
+  failed = 0
+  with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+    futures = [ pool.submit(collect, args, entry, cache) for entry in clusters ]
+    for future in as_completed(futures):
+      cluster, timings = future.result()
+      if "error" in cluster:
+        failed += 1
+      elif args.timings:
+        sys.stderr.write("{0}: {1}\n".format(cluster["inventory"], ", ".join(
+          "{0} {1:.3f}s".format(name, timings[name]) for name in sorted(timings))))
+
+      emit(cluster, args.format, out, explicit_start=True)
+
+  return failed
 
 
 def main(args):
-  parser = argparse.ArgumentParser( 
+  parser = argparse.ArgumentParser(
       description='''A python script to scrape the output of mmlscluster for ingestion in ansible.''')
-  parser.add_argument( '--mmlscluster', metavar="mmlscluster", 
+  parser.add_argument( '--mmlscluster', metavar="mmlscluster",
       dest='mmlscluster', default="/usr/lpp/mmfs/bin/mmlscluster",
       help='''The command for mmlscluster, only specify if installed somewhere than the default.''')
-  parser.add_argument( '--mmlsnodeclass', metavar="mmlsnodeclass", 
+  parser.add_argument( '--mmlsnodeclass', metavar="mmlsnodeclass",
       dest='mmlsnodeclass', default="/usr/lpp/mmfs/bin/mmlsnodeclass",
       help='''The command for mmlsnodeclass, only specify if installed somewhere than the default.''')
-  parser.add_argument( '--mmlsfs', metavar="mmlsfs", 
+  parser.add_argument( '--mmlsfs', metavar="mmlsfs",
       dest='mmlsfs', default="/usr/lpp/mmfs/bin/mmlsfs",
       help='''The command for mmlsfs, only specify if installed somewhere than the default.''')
+  parser.add_argument( '--mmlsfileset', metavar="mmlsfileset",
+      dest='mmlsfileset', default="/usr/lpp/mmfs/bin/mmlsfileset",
+      help='''The command for mmlsfileset, only specify if installed somewhere than the default.''')
   parser.add_argument( '--templates', metavar='templates',
       dest='templates', default=os.path.dirname(os.path.realpath(__file__)),
       help='''The directory containing the TextFSM templates''')
 
+  parser.add_argument( '--parser', dest='parser', choices=["stream", "textfsm"],
+      default="stream",
+      help='''Parse mmlscluster as it is read (stream) or all at once with the TextFSM
+template (textfsm). Both produce the same results.''')
+
+  parser.add_argument( '--nodeclasses', dest='nodeclasses', action='store_true',
+      help='''Run mmlsnodeclass once for every node class instead of only GUI_MGMT_SERVERS.
+The output then has every GUI server (as a list), nodeclasses (the nodes of each class)
+and node_classes (the classes of each node).''')
+
+  parser.add_argument( '--fs-attributes', dest='fsattributes', action='store_true',
+      help='''Run mmlsfs all -Y once for every attribute of every filesystem (block size,
+inode limits, quotas, replication, ...) instead of only the mount point. Each fs entry then
+has the mmlsfs attributes by field name.''')
+
+  parser.add_argument( '--concurrent', dest='concurrent', action='store_true',
+      help='''Run the mm* commands at the same time instead of one after another.''')
+  parser.add_argument( '--timeout', metavar='seconds', dest='timeout',
+      type=float, default=None,
+      help='''Kill an mm* command (and fail) if it runs longer than this.''')
+  parser.add_argument( '--timings', dest='timings', action='store_true',
+      help='''Report the wall-clock time of each mm* command on stderr.''')
+
+  parser.add_argument( '--inventory', metavar='inventory', dest='inventory',
+      default=None,
+      help='''A YAML list of clusters to scrape in parallel (name, prefix and optional
+mm* command paths). A YAML document is streamed for each cluster as it completes.''')
+  parser.add_argument( '--workers', metavar='workers', dest='workers',
+      type=int, default=8,
+      help='''The number of clusters to scrape at the same time with --inventory.''')
+
+  parser.add_argument( '--cache-dir', metavar='cache dir', dest='cachedir',
+      default=CACHE_DIR,
+      help='''The directory to cache probe results in.''')
+  parser.add_argument( '--cache-ttl', metavar='seconds', dest='cachettl',
+      type=float, default=300,
+      help='''How long a cached probe result is used before the command is run again.''')
+  parser.add_argument( '--no-cache', dest='nocache', action='store_true',
+      help='''Always run the mm* commands, neither read nor write the cache.''')
+  parser.add_argument( '--refresh', dest='refresh', action='store_true',
+      help='''Run the mm* commands and replace the cached results.''')
+  parser.add_argument( '--stale-while-revalidate', dest='stale', action='store_true',
+      help='''Serve expired cache entries immediately and refresh them in the background.''')
+
 
   parser.add_argument('--fs', metavar='filesystem',
-      dest='fs', default=None,
-      help='''The name of the filesystem (including /dev/) to use with the csi driver''')
+      dest='fs', default=None, action='append',
+      help='''The name of the filesystem (including /dev/) to use with the csi driver,
+only this filesystem is queried. May be repeated.''')
 
   parser.add_argument('--fset', metavar='fileset',
-      dest='fs', default=None,
-      help='''The name of the filesystem (including /dev/) to use with the csi driver''')
+      dest='fset', default=None, action='append',
+      help='''The name of the fileset (in the --fs filesystems) to use with the csi driver,
+only this fileset is queried. May be repeated.''')
+
+  parser.add_argument( '--format', dest='format', choices=["yaml", "json", "ndjson"],
+      default="yaml",
+      help='''The output format, ndjson writes each cluster on a single line.''')
 
+  profiling.addArguments(parser)
   args = parser.parse_args()
+  profiling.start("deploycsioperator", args.profile, args.cprofile)
+
+  if args.fset and not args.fs:
+    parser.error("--fset requires --fs")
+
+  cache = None
+  if not args.nocache:
+    cache = ProbeCache(args.cachedir, args.cachettl, args.stale, args.refresh)
+
+  try:
+    rc = scrape_main(args, cache)
+  finally:
+    if cache is not None and args.refresh:
+      cache.release()
+
+  if cache is not None:
+    if args.timings:
+      sys.stderr.write("cache: {hit} hit, {miss} miss, {stale} stale\n".format(**cache.stats))
+    if cache.revalidate:
+      cache.revalidate_in_background(sys.argv[1:])
+
+  return rc
+
+
+def scrape_main(args, cache=None):
+  ''' Scrape the local cluster (or the inventory), writing the results to stdout. '''
+  if args.inventory is not None:
+    return 1 if fanout(args, load_inventory(args.inventory), cache=cache) else 0
+
+  probes = cluster_probes(args)
 
-  # Create the template paths
-  SCRIPT_DIR = args.templates
-  MMLSCLUSTER_TEMPL = "{0}/templates/mmlscluster".format(SCRIPT_DIR)
-  MMLSNODECLASS_TEMPL = "{0}/templates/mmlsnodeclass".format(SCRIPT_DIR)
-  MMLSFS_TEMPL = "{0}/templates/mmlsfs".format(SCRIPT_DIR)
+  start = time.time()
+  try:
+    cluster, timings = scrape_cluster(probes, args.concurrent, args.timeout, cache=cache)
+  except ProbeError as e:
+    sys.stderr.write("{0}\n".format(e))
+    return 1
 
-  cluster=mmlscluster(args.mmlscluster,        MMLSCLUSTER_TEMPL)
-  cluster["gui"] = mmlsgui(args.mmlsnodeclass, MMLSNODECLASS_TEMPL)
-  cluster["fs"]  = mmlsfs(args.mmlsfs,         MMLSFS_TEMPL)
+  if args.timings:
+    for name, func, cmd, tmpl, extra in probes:
+      sys.stderr.write("{0}: {1:.3f}s\n".format(cmd, timings[name]))
+    sys.stderr.write("total: {0:.3f}s\n".format(time.time() - start))
 
-  print(yaml.dump(cluster))
+  emit(cluster, args.format)
+  return 0
 
 if __name__ == "__main__":
     sys.exit(main(sys.argv))